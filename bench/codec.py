@@ -0,0 +1,88 @@
+"""Encode cost per payload page, precompiled codecs against inline struct.pack
+
+Both return the bytes that go to the radio as is, so this is the whole cost of a payload.
+
+python -m bench.codec [-n NUMBER]
+"""
+
+import argparse
+import struct
+import timeit
+
+from tx.codec import (
+    CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT,
+    CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT,
+    ANTPowerPage,
+    ANTSpeedPage,
+    CPMeasurement,
+    CSCMeasurement,
+)
+
+
+def legacy_power_page(event_count, cadence, cum_power, power):
+    return struct.pack(
+        "<BB" + "BB" + "HH", *[0x10, event_count, 0xFF, cadence, cum_power, power]
+    )
+
+
+def legacy_speed_page(event_time_ms, cum_rev_count):
+    return struct.pack(
+        "<B" + "BH" + "HH", 0x00, 0xFF, 0xFFFF, event_time_ms, cum_rev_count
+    )
+
+
+def legacy_csc_measurement(wheel_rev, crank_rev, w_event_ms, c_event_ms):
+    return struct.pack(
+        "<BIHHH",
+        CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT
+        | CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT,
+        wheel_rev & 0xFFFFFFFF,
+        w_event_ms & 0xFFFF,
+        crank_rev & 0xFFFF,
+        c_event_ms & 0xFFFF,
+    )
+
+
+def legacy_cp_measurement(flags, power):
+    return struct.pack("<Hh", *[flags, power & 0x7FFF])
+
+
+def per_call(encode, fields, number, repeat=5):
+    timer = timeit.Timer(
+        "encode(*fields)", globals={"encode": encode, "fields": fields}
+    )
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=200_000)
+    args = parser.parse_args()
+
+    power_page = ANTPowerPage()
+    speed_page = ANTSpeedPage()
+    csc = CSCMeasurement()
+    cp = CPMeasurement()
+
+    cases = [
+        ("ANT power 0x10", legacy_power_page, power_page.encode, (12, 90, 31000, 250)),
+        ("ANT speed 0x00", legacy_speed_page, speed_page.encode, (51234, 4321)),
+        (
+            "CSC measurement",
+            legacy_csc_measurement,
+            csc.encode,
+            (123456, 4321, 51234, 50000),
+        ),
+        ("CP measurement", legacy_cp_measurement, cp.encode, (0, 250)),
+    ]
+
+    print(f"{'page':16s} {'struct.pack':>12s} {'codec':>12s}")
+    for name, legacy, codec, fields in cases:
+        assert legacy(*fields) == codec(*fields), name
+        t_legacy = per_call(legacy, fields, args.number)
+        t_codec = per_call(codec, fields, args.number)
+        print(f"{name:16s} {t_legacy * 1e9:9.0f} ns {t_codec * 1e9:9.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""End to end bike -> Conv -> tx benchmark with stand-in transmitters
+
+    python -m bench.pipeline [--bikes N] [--interval S] [--duration S] [--ble-mode M] [--ant-mode M]
+
+Synthetic Keiser frames go through the real KeiserScanner callback, KeiserBike parsing, ANTConv/BLEConv and the ANTTx/BLETx loops and encoders. Only the radios are replaced by the tx.fake sinks, which timestamp every transmit to measure the latency from advertisement to transmit. For the load a whole studio puts on the scanner, with realistic rides and broadcast rates, see bike.loadgen and `main.py --loadgen`.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import struct
+import time
+
+from bike import clock
+from bike.keiser import KEISER_COMPANY_ID, KEISER_FORMAT, KeiserBike, KeiserScanner
+from bike.loadgen import LoadAdvertisement, LoadDevice
+from tx.ant import ANT_MODES
+from tx.ble import BLE_MODE_CP_CSC, BLE_MODE_FTMS, BLE_MODES, BLETx
+from tx.conv import ANTConv, BLEConv
+from tx.fake import FakeCharacteristic, FakeNode
+
+
+def keiser_frame(bike_id, t):
+    """17 byte Keiser real time frame with some plausible, varying values"""
+    power = int(180 + 60 * math.sin(t / 7 + bike_id))
+    cadence = int(850 + 100 * math.sin(t / 5 + bike_id))
+    seconds = int(t)
+    return struct.pack(
+        KEISER_FORMAT,
+        6,
+        30,
+        0,
+        bike_id,
+        cadence,
+        1300,
+        power,
+        int(t / 10),
+        seconds // 60 % 256,
+        seconds % 60,
+        0x8000 | int(t / 10) & 0x7FFF,
+        12,
+    )
+
+
+class Pipeline:
+    """One bike with both outputs wired to fake sinks"""
+
+    def __init__(
+        self, scanner, bike_id, latencies, ble_mode=BLE_MODE_CP_CSC, ant_mode="cp-csc"
+    ) -> None:
+        self.bike_id = bike_id
+        self.bike = KeiserBike(bike_id, scanner)
+        self.ant_conv = ANTConv(self.bike)
+        self.ble_conv = BLEConv(self.bike)
+
+        self.ant_node = FakeNode(on_send=self.on_ant_send)
+        self.ant_tx = ANT_MODES[ant_mode](self.ant_node)
+        self.ble_tx = BLETx(mode=ble_mode)
+        # registered, as far as the fake characteristics are concerned
+        self.ble_tx.ready = True
+        if ble_mode == BLE_MODE_FTMS:
+            self.ble_chars = [FakeCharacteristic(on_changed=self.on_ble_changed)]
+            self.ble_tx.ftms_service.indoor_bike_data = self.ble_chars[0]
+        else:
+            self.ble_chars = [
+                FakeCharacteristic(),
+                FakeCharacteristic(on_changed=self.on_ble_changed),
+            ]
+            self.ble_tx.cp_service.cp_measurement = self.ble_chars[0]
+            self.ble_tx.csc_service.csc_measurement = self.ble_chars[1]
+
+        # injection time by bike reading sequence number, per output
+        self.injected = {"ant": {}, "ble": {}}
+        self.ant_seq = 0
+        self.ble_seq = 0
+        self.latencies = latencies
+
+    def inject(self, scanner, t):
+        msd = {KEISER_COMPANY_ID: keiser_frame(self.bike_id, t)}
+        now = clock()
+        scanner.callback(LoadDevice, LoadAdvertisement(msd))
+        for injected in self.injected.values():
+            injected[self.bike.new_data.seq] = now
+
+    def consumed(self, seq, now, output):
+        injected = self.injected[output]
+        t = injected.pop(seq, None)
+        if t is not None:
+            self.latencies[output].append(now - t)
+        # readings the output skipped are never consumed
+        if len(injected) > 16:
+            for stale in [s for s in injected if s < seq]:
+                del injected[stale]
+
+    def on_ant_send(self, now, msg):
+        if self.ant_conv.seq != self.ant_seq:
+            self.ant_seq = self.ant_conv.seq
+            self.consumed(self.ant_seq, now, "ant")
+
+    def on_ble_changed(self, now, value):
+        if self.ble_conv.seq != self.ble_seq:
+            self.ble_seq = self.ble_conv.seq
+            self.consumed(self.ble_seq, now, "ble")
+
+    def tasks(self):
+        return [
+            self.bike.loop(),
+            self.ant_conv.loop(),
+            self.ant_tx.loop(bike_data=self.ant_conv),
+            self.ble_conv.loop(),
+            self.ble_tx.loop(bike_data=self.ble_conv),
+        ]
+
+
+async def drive(scanner, pipelines, interval, duration):
+    """Injects one frame per bike every `interval` seconds, spread evenly"""
+    step = interval / len(pipelines)
+    start = clock()
+    frames = 0
+    while True:
+        deadline = start + frames * step
+        if deadline - start >= duration:
+            return frames
+        await asyncio.sleep(max(deadline - clock(), 0))
+        pipelines[frames % len(pipelines)].inject(scanner, deadline - start)
+        frames += 1
+
+
+def percentile(values, q):
+    if not values:
+        return math.nan
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+async def run(bikes, interval, duration, ble_mode=BLE_MODE_CP_CSC, ant_mode="cp-csc"):
+    scanner = KeiserScanner()
+    latencies = {"ant": [], "ble": []}
+    pipelines = [
+        Pipeline(scanner, bike_id, latencies, ble_mode, ant_mode)
+        for bike_id in range(bikes)
+    ]
+
+    tasks = [asyncio.create_task(c) for p in pipelines for c in p.tasks()]
+    cpu = time.process_time()
+    wall = clock()
+    frames = await drive(scanner, pipelines, interval, duration)
+    cpu = time.process_time() - cpu
+    wall = clock() - wall
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        # a stage that died would only show up as a low message rate
+        if isinstance(result, Exception):
+            raise result
+
+    ant_msgs = sum(p.ant_node.sent for p in pipelines)
+    ble_msgs = sum(c.changes for p in pipelines for c in p.ble_chars)
+    return frames, cpu, wall, ant_msgs, ble_msgs, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bikes", type=int, default=30)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.357375,
+        help="broadcast interval per bike in seconds",
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--ble-mode", choices=BLE_MODES, default=BLE_MODE_CP_CSC)
+    parser.add_argument("--ant-mode", choices=list(ANT_MODES), default="cp-csc")
+    args = parser.parse_args()
+
+    # missed deadlines under load show up in the latencies, not as warnings
+    logging.basicConfig(level=logging.ERROR)
+    frames, cpu, wall, ant_msgs, ble_msgs, latencies = asyncio.run(
+        run(args.bikes, args.interval, args.duration, args.ble_mode, args.ant_mode)
+    )
+
+    print(f"bikes            {args.bikes}")
+    print(f"frames           {frames} ({frames / wall:.0f}/s)")
+    print(f"tx messages      ANT {ant_msgs / wall:.0f}/s, BLE {ble_msgs / wall:.0f}/s")
+    print(f"cpu              {cpu / wall * 100:.1f}% of one core")
+    print(f"cpu per frame    {cpu / max(frames, 1) * 1e6:.1f} us")
+    for output, values in latencies.items():
+        values.sort()
+        print(
+            f"{output} latency ms   "
+            f"p50 {percentile(values, 0.5) * 1e3:.1f} "
+            f"p90 {percentile(values, 0.9) * 1e3:.1f} "
+            f"p99 {percentile(values, 0.99) * 1e3:.1f} "
+            f"max {percentile(values, 1) * 1e3:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,38 @@
 import asyncio
+import time
+
+# the single monotonic clock of the whole pipeline, in seconds. It is the clock of asyncio's default event loop, so timestamps compare with loop.time()
+clock = time.monotonic
+
+
+class Broadcast:
+    """Sequence numbered "new reading" signal shared by any number of subscribers
+
+    Each subscriber remembers the last sequence number it has seen and waits for a newer one, so a publish can never be missed and a slow subscriber simply skips ahead to the latest reading.
+    """
+
+    def __init__(self) -> None:
+        self.seq = 0
+        self._event = asyncio.Event()
+
+    def publish(self):
+        self.seq += 1
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, seq):
+        while self.seq == seq:
+            await self._event.wait()
+        return self.seq
+
 
 class Bike:
     def __init__(self) -> None:
-        self.new_data = asyncio.Event()
-        self.new_data.clear()
+        self.new_data = Broadcast()
         self.no_data = True
+        # clock() of the latest frame, duplicates included, for liveness
+        self.last_seen = float("-inf")
+        # clock() of the latest published reading, for latency and sampling
+        self.last_changed = float("-inf")
+        # gone for long enough that outputs and scanning power down, until the next reading
+        self.idle = False
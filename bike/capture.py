@@ -0,0 +1,89 @@
+import asyncio
+import mmap
+import struct
+
+from .keiser import *
+
+CAPTURE_MAGIC = b"KSRCAP01"
+# wall clock time of reception, raw 17 byte Keiser manufacturer data
+CAPTURE_RECORD = struct.Struct("<d%ds" % KEISER_MSD_LEN)
+
+
+class CaptureWriter:
+    """Appends raw Keiser frames to a capture file
+
+    The file is the 8 byte magic followed by fixed size records, see `CAPTURE_RECORD`.
+    """
+
+    def __init__(self, path) -> None:
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+
+    def write(self, timestamp, payload):
+        self.file.write(CAPTURE_RECORD.pack(timestamp, payload))
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader:
+    """Memory mapped view of a capture file"""
+
+    def __init__(self, path) -> None:
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a Keiser capture file")
+        size = len(self.mm) - len(CAPTURE_MAGIC)
+        # ignore a record cut short by an interrupted capture
+        size -= size % CAPTURE_RECORD.size
+        self.buffer = memoryview(self.mm)[len(CAPTURE_MAGIC) :][:size]
+
+    def __len__(self):
+        return len(self.buffer) // CAPTURE_RECORD.size
+
+    def __iter__(self):
+        """Yields (timestamp, payload) tuples"""
+        return CAPTURE_RECORD.iter_unpack(self.buffer)
+
+    def close(self):
+        self.buffer.release()
+        self.mm.close()
+
+
+class ReplayKeiserBike(KeiserBike):
+    """Replays a capture file through `parse_keiser_msd`
+
+    `speed` scales time: 1 replays in real time, N replays N times faster and 0 as fast as possible.
+    """
+
+    def __init__(self, path, bike_id=0, speed=1.0, repeat=False) -> None:
+        super().__init__(bike_id, KeiserScanner())
+        self.reader = CaptureReader(path)
+        self.speed = speed
+        self.repeat = repeat
+        if speed > 0:
+            self.timeout = KEISER_STALE_TIMEOUT / speed
+
+    async def replay(self):
+        while True:
+            start = clock()
+            t0 = None
+            for timestamp, payload in self.reader:
+                if t0 is None:
+                    t0 = timestamp
+                if self.speed > 0:
+                    delay = start + (timestamp - t0) / self.speed - clock()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    await asyncio.sleep(0)
+                if self.parse_keiser_msd({KEISER_COMPANY_ID: payload}):
+                    self.seen(clock())
+            if not self.repeat:
+                break
+
+    async def loop(self):
+        async with asyncio.TaskGroup() as g:
+            g.create_task(self.replay())
+            g.create_task(self.watch())
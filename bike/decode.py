@@ -0,0 +1,45 @@
+"""Vectorized decoding of many Keiser frames at once, for offline analytics"""
+
+import numpy as np
+
+from .keiser import *
+from .capture import CaptureReader
+
+NUMPY_CODES = {"B": "u1", "H": "<u2"}
+
+# packed like the frame itself, itemsize is KEISER_MSD_LEN
+KEISER_DTYPE = np.dtype([(name, NUMPY_CODES[code]) for name, code in KEISER_FIELDS])
+# record layout of bike.capture files
+CAPTURE_DTYPE = np.dtype([("timestamp", "<f8")] + KEISER_DTYPE.descr)
+
+
+def scale(raw, realtime_only=True):
+    """Typed, scaled columns from a structured array of raw frames
+
+    Values have the same units as the attributes of KeiserBike.
+    """
+    if realtime_only:
+        raw = raw[raw["data_type"] == 0]
+    columns = {name: raw[name] for name in raw.dtype.names}
+    columns["cadence"] = scale_cadence(raw["cadence"])
+    columns["heart_rate"] = scale_heart_rate(raw["heart_rate"])
+    columns["distance"] = scale_distance(raw["distance"])
+    columns["resistence"] = gear_to_resistance(raw["gear"])
+    return columns
+
+
+def decode_frames(buf, realtime_only=True):
+    """Decodes a buffer of concatenated 17 byte frames"""
+    raw = np.frombuffer(buf, dtype=KEISER_DTYPE, count=len(buf) // KEISER_MSD_LEN)
+    return scale(raw, realtime_only)
+
+
+def decode_capture(path, realtime_only=True):
+    """Decodes a whole capture file, with a `timestamp` column"""
+    reader = CaptureReader(path)
+    raw = np.frombuffer(reader.buffer, dtype=CAPTURE_DTYPE)
+    # copy out so the file can be closed
+    columns = {k: np.array(v) for k, v in scale(raw, realtime_only).items()}
+    del raw
+    reader.close()
+    return columns
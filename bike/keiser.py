@@ -1,12 +1,195 @@
 import asyncio
+import logging
 import struct
+import time
 from bleak import BleakScanner
 
 from . import *
 
+log = logging.getLogger(__name__)
+
+KEISER_COMPANY_ID = 0x0102
+KEISER_MSD_LEN = 17
+# layout of the manufacturer data, shared by the live parser and bike.decode
+KEISER_FIELDS = (
+    ("version_major", "B"),
+    ("version_minor", "B"),
+    ("data_type", "B"),
+    ("bike_id", "B"),
+    ("cadence", "H"),
+    ("heart_rate", "H"),
+    ("power", "H"),
+    ("calories", "H"),
+    ("minutes", "B"),
+    ("seconds", "B"),
+    ("distance", "H"),
+    ("gear", "B"),
+)
+KEISER_FORMAT = "<" + "".join(code for _, code in KEISER_FIELDS)
+# a bike is considered gone after this many seconds without a frame
+KEISER_STALE_TIMEOUT = 2
+# and idle after this many more, see KeiserBike.watch
+KEISER_IDLE_TIMEOUT = 60
+# broadcast interval of older and of current firmware, seconds
+KEISER_BROADCAST_INTERVALS = (2.0, 0.357375)
+# while every bike is idle the scanner listens for a window no shorter than the
+# slowest interval and pauses for no longer than the fastest: a bike that starts
+# broadcasting during a pause has its next frame land in the following window,
+# so it is picked up within one of its broadcast intervals
+KEISER_IDLE_SCAN_WINDOW = 2.5
+KEISER_IDLE_SCAN_PAUSE = 0.35
+
+
+# scaling of the raw fields, written to work on scalars and NumPy arrays alike
+
+
+def scale_cadence(raw):
+    """rpm"""
+    return raw / 10
+
+
+def scale_heart_rate(raw):
+    """bpm"""
+    return raw / 10
+
+
+def scale_distance(raw):
+    """km, bit 15 set means the bike counts in km, otherwise in miles"""
+    return (raw & 0x7FFF) / 10 * (1.609344 - 0.609344 * (raw >> 15))
+
+
+def gear_to_resistance(gear):
+    """percent of the 24 gears"""
+    return gear / 24 * 100
+
+
+class KeiserScanner:
+    """One BLE scanner shared by every Keiser bike in range.
+
+    Each advertisement is matched once and dispatched to the subscribed bikes through a dict keyed by equipment ID, so the cost per advertisement does not grow with the fleet.
+
+    Advertisements are rejected on company ID, length and equipment ID before anything is unpacked. A frame identical to the previous one of that bike only refreshes its liveness, the bikes are not woken up again.
+
+    By default discovery is restarted after every frame, since BlueZ only reports an advertisement again once its payload changes. In continuous mode the scanner is started once for the lifetime of the process and asks BlueZ to report duplicates, so frames are never lost in a restart gap.
+
+    While every subscribed bike is idle, scanning is duty cycled in either mode: one `KEISER_IDLE_SCAN_WINDOW` long enough to catch a frame of any firmware, then `idle_pause` seconds off. The first frame ends it. Resuming takes at most one broadcast interval as long as `idle_pause` is not longer than the interval, otherwise up to `idle_pause` plus the interval. An `idle_pause` of 0 scans all the time.
+    """
+
+    def __init__(
+        self, continuous=False, capture=None, idle_pause=KEISER_IDLE_SCAN_PAUSE
+    ) -> None:
+        self.bikes = {}
+        # last accepted raw frame by equipment ID
+        self.last_frames = {}
+        self.frames = 0
+        self.duplicates = 0
+        self.new_data = asyncio.Event()
+        self.new_data.clear()
+
+        self.continuous = continuous
+        self.scanner = None
+        # optional bike.capture.CaptureWriter recording every Keiser frame
+        self.capture = capture
+        self.idle_pause = idle_pause
+
+    def subscribe(self, bike):
+        self.bikes.setdefault(bike.bike_id, []).append(bike)
+
+    def unsubscribe(self, bike):
+        bikes = self.bikes.get(bike.bike_id, [])
+        if bike in bikes:
+            bikes.remove(bike)
+        if not bikes:
+            self.bikes.pop(bike.bike_id, None)
+            self.last_frames.pop(bike.bike_id, None)
+
+    def callback(self, device, advertisement_data):
+        # the company ID alone identifies Keiser, the name is not needed
+        if self.dispatch(advertisement_data.manufacturer_data):
+            self.new_data.set()
+
+    def dispatch(self, msd: dict):
+        v = msd.get(KEISER_COMPANY_ID)
+        if v is None or len(v) != KEISER_MSD_LEN:
+            return False
+        if self.capture is not None:
+            self.capture.write(time.time(), v)
+        bikes = self.bikes.get(v[3])
+        if not bikes or v[2] != 0:
+            return False
+        now = clock()
+        self.frames += 1
+        if v == self.last_frames.get(v[3]):
+            self.duplicates += 1
+            for bike in bikes:
+                bike.refresh(now)
+            return True
+        self.last_frames[v[3]] = v
+        fields = struct.unpack(KEISER_FORMAT, v)
+        for bike in bikes:
+            bike.update(fields)
+            bike.seen(now)
+        return True
+
+    def all_idle(self):
+        if self.idle_pause <= 0 or not self.bikes:
+            return False
+        return all(bike.idle for bikes in self.bikes.values() for bike in bikes)
+
+    async def scan_window(self, timeout):
+        """Scans until a frame arrives or for `timeout` seconds, returns whether one did"""
+        self.new_data.clear()
+        await self.scanner.start()
+        try:
+            async with asyncio.timeout(timeout):
+                await self.new_data.wait()
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def loop(self):
+        if self.continuous:
+            await self.loop_continuous()
+            return
+        self.scanner = BleakScanner(self.callback)
+        while True:
+            idle = self.all_idle()
+            timeout = KEISER_IDLE_SCAN_WINDOW if idle else 2
+            if not await self.scan_window(timeout):
+                log.debug("scan timeout, restarting")
+            await self.scanner.stop()
+            self.new_data.clear()
+            if idle and self.all_idle():
+                await asyncio.sleep(self.idle_pause)
+
+    async def loop_continuous(self):
+        self.scanner = BleakScanner(
+            self.callback, bluez={"filters": {"DuplicateData": True}}
+        )
+        await self.scanner.start()
+        scanning = True
+        try:
+            while True:
+                # checked rarely, frames do not wake this task up
+                await asyncio.sleep(KEISER_IDLE_SCAN_WINDOW)
+                while self.all_idle():
+                    await self.scanner.stop()
+                    scanning = False
+                    await asyncio.sleep(self.idle_pause)
+                    scanning = True
+                    await self.scan_window(KEISER_IDLE_SCAN_WINDOW)
+        finally:
+            if scanning:
+                await self.scanner.stop()
+
 
 class KeiserBike(Bike):
-    def __init__(self, bike_id=0) -> None:
+    def __init__(
+        self,
+        bike_id=0,
+        scanner: KeiserScanner = None,
+        idle_timeout=KEISER_IDLE_TIMEOUT,
+    ) -> None:
         super().__init__()
 
         self.bike_id = bike_id & 0xFF
@@ -22,67 +205,114 @@ class KeiserBike(Bike):
         self.distance = 0
         self.gear = 0
 
-        self.scanner = BleakScanner(self.callback)
+        self.timeout = KEISER_STALE_TIMEOUT
+        # None never goes idle
+        self.idle_timeout = idle_timeout
+        # idle counts from here until the first frame
+        self.started = clock()
 
-    def callback(self, device, advertisement_data):
-        if device.name == "M3":
-            # print(advertisement_data)
-            if hasattr(advertisement_data, "manufacturer_data"):
-                msd = advertisement_data.manufacturer_data
-                if self.parse_keiser_msd(msd):
-                    self.new_data.set()
+        # a bike without a shared scanner runs its own
+        self.own_scanner = scanner is None
+        self.scanner = KeiserScanner() if scanner is None else scanner
+        self.scanner.subscribe(self)
 
     def parse_keiser_msd(self, msd: dict):
         for k, v in msd.items():
-            if k == 0x0102 and 17 == len(v) and v[3] == self.bike_id and v[2] == 0:
-                (
-                    self.version_major,
-                    self.version_minor,
-                    self.data_type,
-                    self.bike_id,
-                    self.cadence,
-                    self.heart_rate,
-                    self.power,
-                    self.calories,
-                    self.minutes,
-                    self.seconds,
-                    self.distance,
-                    self.gear,
-                ) = struct.unpack("<BBB" + "BHHH" + "HBBHB", v)
-
-                self.cadence /= 10
-                self.heart_rate /= 10
-                if self.distance >> 15 == 0:
-                    # mile
-                    self.distance * 1609.344
-                # km
-                self.distance = (self.distance & 0x7FFF) / 10
-                self.resistence = self.gear / 24 * 100
-                # print(f"Version Major: {version_major}")
-                # print(f"Version Minor: {version_minor}")
-                # print(f"Data Type: {data_type}")
-                # print(f"Equipment ID: {bike_id}")
-                # print(f"Cadence: {cadence}")
-                # print(f"Heart Rate: {heart_rate}")
-                # print(f"Power: {power}")
-                # print(f"Caloric Burn: {calories}")
-                # print(f"Duration Minutes: {minutes}")
-                # print(f"Duration Seconds: {seconds}")
-                # print(f"Distance: {distance}")
-                # print(f"Gear: {gear}")
-
+            if (
+                k == KEISER_COMPANY_ID
+                and KEISER_MSD_LEN == len(v)
+                and v[3] == self.bike_id
+                and v[2] == 0
+            ):
+                self.update(struct.unpack(KEISER_FORMAT, v))
                 return True
         return False
 
-    async def loop(self):
+    def update(self, fields):
+        # same order as KEISER_FIELDS
+        (
+            self.version_major,
+            self.version_minor,
+            self.data_type,
+            self.bike_id,
+            self.cadence,
+            self.heart_rate,
+            self.power,
+            self.calories,
+            self.minutes,
+            self.seconds,
+            self.distance,
+            self.gear,
+        ) = fields
+
+        self.cadence = scale_cadence(self.cadence)
+        self.heart_rate = scale_heart_rate(self.heart_rate)
+        self.distance = scale_distance(self.distance)
+        self.resistence = gear_to_resistance(self.gear)
+        # print(f"Version Major: {version_major}")
+        # print(f"Version Minor: {version_minor}")
+        # print(f"Data Type: {data_type}")
+        # print(f"Equipment ID: {bike_id}")
+        # print(f"Cadence: {cadence}")
+        # print(f"Heart Rate: {heart_rate}")
+        # print(f"Power: {power}")
+        # print(f"Caloric Burn: {calories}")
+        # print(f"Duration Minutes: {minutes}")
+        # print(f"Duration Seconds: {seconds}")
+        # print(f"Distance: {distance}")
+        # print(f"Gear: {gear}")
+
+    def seen(self, now):
+        self.last_seen = now
+        self.last_changed = now
+        self.no_data = False
+        if self.idle:
+            self.idle = False
+            log.info("bike %d back from idle", self.bike_id)
+        self.new_data.publish()
+
+    def refresh(self, now):
+        """Same reading again, only wake subscribers up if the bike was gone
+
+        Only liveness moves on, `last_changed` stays at the frame the reading came with.
+        """
+        self.last_seen = now
+        if self.no_data:
+            self.seen(now)
+
+    async def watch(self):
+        """Flag the bike as gone once no frame was seen for `timeout` seconds, and idle `idle_timeout` seconds later."""
         while True:
-            await self.scanner.start()
-            try:
-                async with asyncio.timeout(2):
-                    await self.new_data.wait()
-                    self.no_data = False
-            except asyncio.TimeoutError:
-                print("Scan timeout, restarting\r", end="")
+            now = clock()
+            stale_in = self.last_seen + self.timeout - now
+            if stale_in > 0:
+                await asyncio.sleep(stale_in)
+                continue
+            if not self.no_data:
                 self.no_data = True
-            await self.scanner.stop()
-            self.new_data.clear()
+                # let subscribers see the drop out
+                self.new_data.publish()
+            seq = self.new_data.seq
+            if self.idle_timeout is not None and not self.idle:
+                since = max(self.last_seen, self.started) + self.timeout
+                idle_in = since + self.idle_timeout - now
+                if idle_in > 0:
+                    try:
+                        async with asyncio.timeout(idle_in):
+                            await self.new_data.wait(seq)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.idle = True
+                log.info("bike %d idle", self.bike_id)
+                self.new_data.publish()
+                seq = self.new_data.seq
+            await self.new_data.wait(seq)
+
+    async def loop(self):
+        if not self.own_scanner:
+            await self.watch()
+            return
+        async with asyncio.TaskGroup() as g:
+            g.create_task(self.scanner.loop())
+            g.create_task(self.watch())
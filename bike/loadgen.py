@@ -0,0 +1,208 @@
+"""Synthetic Keiser fleet, to load the real scanner callback path
+
+Frames are packed like a bike sends them and go through `KeiserScanner.callback`, so company ID, length and equipment ID filtering, duplicate detection, unpacking and scaling all run as they do with a radio. Every bike rides a profile and has a firmware with its own broadcast interval; the fields only change once a second as on the bike, so at the fast interval most frames are duplicates.
+
+    LoadGenerator(scanner, range(200), rate=2).loop()
+
+`rate` multiplies every broadcast rate, and the ride runs that much faster so the share of duplicate frames stays that of the firmware. Raise it until `lag` grows to find the ceiling of the process.
+"""
+
+import asyncio
+import heapq
+import logging
+import math
+import random
+import struct
+import time
+
+from .keiser import *
+
+log = logging.getLogger(__name__)
+
+# version major, version minor, broadcast interval in seconds
+LOADGEN_FIRMWARES = (
+    (6, 22, 2.0),
+    (6, 30, 0.357375),
+)
+
+
+# profiles map the time into the ride and a per bike phase in [0, 1) to
+# (power W, cadence rpm), or None while the bike is not broadcasting
+
+
+def profile_ramp(t, phase):
+    """20 W a minute from 100 W, then over again"""
+    step = (t / 60 + phase * 10) % 10
+    return 100 + 20 * step, 75 + 2 * step
+
+
+def profile_intervals(t, phase):
+    """3 min at 280 W, 2 min at 140 W"""
+    if (t + phase * 300) % 300 < 180:
+        return 280, 95
+    return 140, 80
+
+
+def profile_sprint(t, phase):
+    """20 s sprints every 2 minutes, easy spinning in between"""
+    if (t + phase * 120) % 120 < 20:
+        return 800, 120
+    return 150, 85
+
+
+def profile_dropout(t, phase):
+    """Steady riding, out of range for 10 s every minute"""
+    if (t + phase * 60) % 60 < 10:
+        return None
+    return 200 + 30 * math.sin(t / 20), 88
+
+
+LOADGEN_PROFILES = {
+    "ramp": profile_ramp,
+    "intervals": profile_intervals,
+    "sprint": profile_sprint,
+    "dropout": profile_dropout,
+}
+
+
+class LoadDevice:
+    """Stands in for the bleak BLEDevice, the scanner does not look at it"""
+
+    name = "M3"
+    address = "00:00:00:00:00:00"
+
+
+class LoadAdvertisement:
+    def __init__(self, manufacturer_data) -> None:
+        self.manufacturer_data = manufacturer_data
+
+
+class SyntheticBike:
+    def __init__(self, bike_id, profile, firmware, phase=0.0) -> None:
+        self.bike_id = bike_id & 0xFF
+        self.profile = profile
+        self.version_major, self.version_minor, self.interval = firmware
+        self.phase = phase
+        self.calories = 0.0
+        # km
+        self.distance = 0.0
+        self.second = None
+        self.last_frame = None
+
+    def frame(self, t):
+        """17 byte manufacturer data at `t` seconds into the ride, None during a dropout"""
+        second = int(t)
+        if second == self.second:
+            return self.last_frame
+        reading = self.profile(second, self.phase)
+        elapsed = 1 if self.second is None else second - self.second
+        self.second = second
+        if reading is None:
+            self.last_frame = None
+            return None
+        power, cadence = reading
+        # kcal, at roughly 24 % efficiency
+        self.calories += power * elapsed / 1000
+        # km, the bike's own speed estimate
+        self.distance += cadence * 0.4 * elapsed / 3600
+        self.last_frame = struct.pack(
+            KEISER_FORMAT,
+            self.version_major,
+            self.version_minor,
+            0,
+            self.bike_id,
+            int(cadence * 10),
+            1200 + int(power),
+            int(power),
+            int(self.calories) & 0xFFFF,
+            second // 60 % 256,
+            second % 60,
+            0x8000 | int(self.distance * 10) & 0x7FFF,
+            int(power / 40) % 24 + 1,
+        )
+        return self.last_frame
+
+
+class LoadGenerator:
+    """Feeds the frames of many synthetic bikes into a KeiserScanner
+
+    Profiles and firmwares are dealt out to the bike IDs in turn unless given.
+    """
+
+    def __init__(
+        self,
+        scanner,
+        bike_ids,
+        rate=1.0,
+        profiles=None,
+        firmwares=LOADGEN_FIRMWARES,
+        seed=0,
+    ) -> None:
+        self.scanner = scanner
+        self.rate = rate
+        profiles = list(LOADGEN_PROFILES) if profiles is None else profiles
+        # phases and the stagger of the first frames, reproducible by `seed`
+        self.rng = random.Random(seed)
+        self.bikes = [
+            SyntheticBike(
+                bike_id,
+                LOADGEN_PROFILES[profiles[i % len(profiles)]],
+                firmwares[i % len(firmwares)],
+                self.rng.random(),
+            )
+            for i, bike_id in enumerate(bike_ids)
+        ]
+
+        self.frames = 0
+        # how far behind schedule the latest frames went out, and the worst so far
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def inject(self, bike, t):
+        v = bike.frame(t)
+        if v is None:
+            return
+        self.scanner.callback(LoadDevice, LoadAdvertisement({KEISER_COMPANY_ID: v}))
+        self.frames += 1
+
+    async def loop(self, duration=None, report=10):
+        """Broadcasts until cancelled or for `duration` seconds, logs the load every `report` seconds"""
+        start = clock()
+        # bikes do not broadcast in step, spread them over their interval
+        due = [
+            (start + self.rng.random() * bike.interval / self.rate, i)
+            for i, bike in enumerate(self.bikes)
+        ]
+        heapq.heapify(due)
+        next_report = start + report
+        frames = 0
+        cpu = time.process_time()
+        while True:
+            deadline, i = due[0]
+            if duration is not None and deadline - start >= duration:
+                return self.frames
+            delay = deadline - clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = clock()
+            # everything that is due goes out in one go
+            while due[0][0] <= now:
+                deadline, i = due[0]
+                bike = self.bikes[i]
+                self.inject(bike, (now - start) * self.rate)
+                heapq.heapreplace(due, (deadline + bike.interval / self.rate, i))
+            self.lag = now - deadline
+            self.max_lag = max(self.max_lag, self.lag)
+            if now >= next_report:
+                elapsed = now - next_report + report
+                log.info(
+                    "%d bikes %.0f frames/s %.1f%% cpu lag %.3f s max %.3f s",
+                    len(self.bikes),
+                    (self.frames - frames) / elapsed,
+                    (time.process_time() - cpu) / elapsed * 100,
+                    self.lag,
+                    self.max_lag,
+                )
+                frames = self.frames
+                cpu = time.process_time()
+                next_report = now + report
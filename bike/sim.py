@@ -17,5 +17,5 @@ class SimCrankPowerEncoder(Bike):
             self.no_data = False
             self.rev_inc = interval * 1.1
             self.power = random.randint(120, 133)
-            self.new_data.set()
-            self.new_data.clear()
+            self.last_seen = self.last_changed = clock()
+            self.new_data.publish()
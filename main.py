@@ -1,41 +1,276 @@
+import argparse
 import asyncio
-import sys
+import logging
 
-from tx.ant import ANTTx
-from tx.ble import BLETx
+from tx.ant import ANT_MODES, ANTChannelAllocator, SENSOR_ID
+from tx.ble import BLE_MODE_CP_CSC, BLE_MODES, BLETx
 from tx.conv import ANTConv, BLEConv
-from bike.keiser import KeiserBike
+from tx.shm import TelemetryWriter
+from bike.keiser import (
+    KEISER_IDLE_SCAN_PAUSE,
+    KEISER_IDLE_TIMEOUT,
+    KeiserBike,
+    KeiserScanner,
+)
+from bike.capture import CaptureWriter, ReplayKeiserBike
+from bike.loadgen import LoadGenerator
 from bike.sim import SimCrankPowerEncoder
+from monitor.metrics import Metrics
+from monitor.log import start_logging
+from monitor.status import StatusReporter
+from monitor.watchdog import LoopWatchdog
+from record.fit import FitRecorder
+from record.store import StoreWriter
 
+log = logging.getLogger("main")
 
-async def main(bike_id: int, mock: bool):
-    ant_tx = ANTTx()
-    ble_tx = BLETx()
-    await ble_tx.setup()
 
-    src = SimCrankPowerEncoder() if mock else KeiserBike(bike_id=bike_id)
+async def main(
+    bike_ids: list,
+    mock: bool,
+    continuous: bool = False,
+    capture: str = None,
+    replay: str = None,
+    replay_speed: float = 1.0,
+    metrics_port: int = None,
+    metrics_interval: float = 60,
+    telemetry: str = None,
+    ble_mode: str = BLE_MODE_CP_CSC,
+    ant_mode: str = "cp-csc",
+    stall_threshold: float = 0.2,
+    status_interval: float = 5,
+    fit_dir: str = None,
+    store: str = None,
+    loadgen: float = None,
+    idle_timeout: float = KEISER_IDLE_TIMEOUT,
+    idle_scan_pause: float = KEISER_IDLE_SCAN_PAUSE,
+):
+    metrics = None if metrics_port is None else Metrics()
+    telemetry = None if telemetry is None else TelemetryWriter(telemetry)
 
-    ant_bike_data = ANTConv(src)
-    ble_bike_data = BLEConv(src)
+    # both transports start up in the task group below, in parallel with the
+    # scanner, and recover from losing their device without a restart
+    allocator = ANTChannelAllocator()
+    ble_tx = BLETx(metrics=metrics, mode=ble_mode)
+
+    scanner = None
+    writer = None
+    if replay is not None:
+        srcs = [ReplayKeiserBike(replay, bike_ids[0], speed=replay_speed)]
+    elif mock:
+        srcs = [SimCrankPowerEncoder()]
+    else:
+        writer = None if capture is None else CaptureWriter(capture)
+        scanner = KeiserScanner(
+            continuous=continuous, capture=writer, idle_pause=idle_scan_pause
+        )
+        if loadgen is not None:
+            loadgen = LoadGenerator(scanner, bike_ids, rate=loadgen)
+        srcs = [KeiserBike(bike_id, scanner, idle_timeout) for bike_id in bike_ids]
+
+    # every bike gets its own ANT+ channels, BLE serves the first bike
+    pipelines = []
+    recorders = []
+    for bike_id, src in zip(bike_ids, srcs):
+        ant_tx = ANT_MODES[ant_mode](metrics=metrics, device_number=SENSOR_ID + bike_id)
+        allocator.allocate(ant_tx)
+        # both convs see the same readings, one is enough for rx_to_conv
+        ant_bike_data = ANTConv(src, metrics=metrics)
+        if telemetry is not None:
+            ant_bike_data.listeners.append(telemetry)
+        if fit_dir is not None:
+            recorder = FitRecorder(fit_dir, bike_id)
+            ant_bike_data.listeners.append(recorder)
+            recorders.append(recorder)
+        if store is not None:
+            recorder = StoreWriter(store, bike_id)
+            ant_bike_data.listeners.append(recorder)
+            recorders.append(recorder)
+        pipelines.append((src, ant_bike_data, ant_tx))
+    ble_bike_data = BLEConv(srcs[0])
 
     try:
         async with asyncio.TaskGroup() as g:
-            g.create_task(src.loop())
-            g.create_task(ant_bike_data.loop())
-            g.create_task(ant_tx.loop(bike_data=ant_bike_data))
+            g.create_task(
+                LoopWatchdog(threshold=stall_threshold, metrics=metrics).loop()
+            )
+            if loadgen is not None:
+                g.create_task(loadgen.loop())
+            elif scanner is not None:
+                g.create_task(scanner.loop())
+            if metrics is not None:
+                g.create_task(metrics.serve(port=metrics_port))
+                g.create_task(metrics.summary_loop(metrics_interval))
+            if status_interval > 0:
+                convs = [ant_bike_data for _, ant_bike_data, _ in pipelines]
+                g.create_task(StatusReporter(convs, status_interval).loop())
+            for recorder in recorders:
+                g.create_task(recorder.loop())
+            g.create_task(allocator.loop())
+            g.create_task(ble_tx.run())
+            for src, ant_bike_data, ant_tx in pipelines:
+                g.create_task(src.loop())
+                g.create_task(ant_bike_data.loop())
+                g.create_task(ant_tx.loop(bike_data=ant_bike_data))
             g.create_task(ble_bike_data.loop())
             g.create_task(ble_tx.loop(bike_data=ble_bike_data))
 
     except asyncio.exceptions.CancelledError:
-        print("Cancelled by user")
+        log.info("cancelled by user")
+    finally:
+        allocator.close()
+        if writer is not None:
+            writer.close()
+        if telemetry is not None:
+            telemetry.close()
+        for recorder in recorders:
+            recorder.close()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        bike_id = int(sys.argv[1])
-        mock = False
-    else:
-        bike_id = 0
-        mock = True
+    parser = argparse.ArgumentParser(description="Keiser M to ANT+/BLE bridge")
+    parser.add_argument(
+        "bike_ids",
+        metavar="bike_id",
+        type=int,
+        nargs="*",
+        help="Keiser equipment IDs, simulate if omitted",
+    )
+    parser.add_argument(
+        "--continuous",
+        action="store_true",
+        help="keep the BLE scanner running instead of restarting it per frame",
+    )
+    parser.add_argument("--capture", metavar="PATH", help="record raw Keiser frames")
+    parser.add_argument(
+        "--replay", metavar="PATH", help="replay a capture instead of scanning"
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="replay N times faster than real time, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve per stage latency histograms on http://127.0.0.1:PORT/metrics",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="seconds between latency summaries on the console",
+    )
+    parser.add_argument(
+        "--telemetry",
+        metavar="NAME",
+        help="publish every reading to the shared memory ring NAME, see tx.shm",
+    )
+    parser.add_argument(
+        "--ant-mode",
+        choices=list(ANT_MODES),
+        default="cp-csc",
+        help="bicycle power and speed channels, or one fitness equipment channel per bike",
+    )
+    parser.add_argument(
+        "--ble-mode",
+        choices=BLE_MODES,
+        default=BLE_MODE_CP_CSC,
+        help="separate cycling power and speed/cadence services, or one fitness machine service",
+    )
+    parser.add_argument(
+        "--stall-threshold",
+        type=float,
+        default=0.2,
+        help="report the stack of the running task when the event loop is stuck this long",
+    )
+    parser.add_argument(
+        "--status-interval",
+        type=float,
+        default=5,
+        help="seconds between status lines of every bike, 0 for none",
+    )
+    parser.add_argument(
+        "--fit-dir",
+        metavar="DIR",
+        help="record a FIT activity per bike and session into DIR",
+    )
+    parser.add_argument(
+        "--store",
+        metavar="DIR",
+        help="keep every bike's history with 1 s and 1 min rollups in DIR, see record.store",
+    )
+    parser.add_argument(
+        "--loadgen",
+        type=float,
+        metavar="RATE",
+        help="feed synthetic Keiser frames for the bike IDs through the scanner at RATE times their broadcast rate, instead of scanning",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=KEISER_IDLE_TIMEOUT,
+        metavar="SECONDS",
+        help="close a bike's ANT+ channels and stop its BLE notifications once it was gone this long, 0 never (default %(default)s)",
+    )
+    parser.add_argument(
+        "--idle-scan-pause",
+        type=float,
+        default=KEISER_IDLE_SCAN_PAUSE,
+        metavar="SECONDS",
+        help="while every bike is idle, pause scanning this long between scan windows, 0 scans all the time. Up to the bikes' broadcast interval they still resume within one interval (default %(default)s)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    )
+    parser.add_argument(
+        "--no-uvloop",
+        action="store_true",
+        help="use asyncio's event loop even if uvloop is installed",
+    )
+    args = parser.parse_args()
+
+    mock = not args.bike_ids
+    bike_ids = [0] if mock else args.bike_ids
 
-    asyncio.run(main(bike_id, mock))
+    listener = start_logging(args.log_level)
+
+    # uvloop is optional, it is cheaper per callback than asyncio's own loop
+    loop_factory = None
+    if not args.no_uvloop:
+        try:
+            import uvloop
+
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            pass
+
+    try:
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(
+                main(
+                    bike_ids,
+                    mock,
+                    args.continuous,
+                    args.capture,
+                    args.replay,
+                    args.replay_speed,
+                    args.metrics_port,
+                    args.metrics_interval,
+                    args.telemetry,
+                    args.ble_mode,
+                    args.ant_mode,
+                    args.stall_threshold,
+                    args.status_interval,
+                    args.fit_dir,
+                    args.store,
+                    args.loadgen,
+                    args.idle_timeout or None,
+                    args.idle_scan_pause,
+                )
+            )
+    finally:
+        listener.stop()
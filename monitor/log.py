@@ -0,0 +1,38 @@
+"""Logging off the event loop
+
+Records are put on a queue by the thread that logs them and formatted and written by a QueueListener thread, so a slow terminal, journald or SD card never holds up the event loop. Formatting is deferred too: log calls pass their fields as arguments, the message is only built on the listener thread.
+"""
+
+import logging
+import logging.handlers
+import queue
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues the record as is, QueueHandler would format it on the calling thread
+
+    Only for an in-process queue, and the arguments must not change after the call, which holds for the scalars logged here.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_logging(level=logging.INFO, handler=None):
+    """Routes the root logger through a queue, returns the started QueueListener to stop at exit"""
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+    )
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(DeferredQueueHandler(records))
+    listener = logging.handlers.QueueListener(
+        records, handler, respect_handler_level=True
+    )
+    listener.start()
+    return listener
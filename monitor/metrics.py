@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# values below 2**SUB_BITS microseconds get a bucket each, above that every power of two is split into 2**(SUB_BITS - 1) buckets, about 6% resolution
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+HALF_COUNT = SUB_COUNT >> 1
+# a minute, anything slower ends up in the last bucket
+MAX_US = 60_000_000
+
+
+def bucket_index(us):
+    if us < SUB_COUNT:
+        return us
+    shift = us.bit_length() - SUB_BITS
+    return SUB_COUNT + (shift - 1) * HALF_COUNT + (us >> shift) - HALF_COUNT
+
+
+def bucket_upper_us(index):
+    if index < SUB_COUNT:
+        return index
+    shift = (index - SUB_COUNT) // HALF_COUNT + 1
+    sub = (index - SUB_COUNT) % HALF_COUNT + HALF_COUNT
+    return ((sub + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """HDR style log-linear histogram of latencies, constant memory and O(1) record"""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (bucket_index(MAX_US) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = min(max(int(seconds * 1e6), 0), MAX_US)
+        self.counts[bucket_index(us)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-quantile, in seconds"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_upper_us(index) / 1e6, self.max)
+        return self.max
+
+
+class Metrics:
+    """Latency histograms per pipeline stage and bike
+
+    Stages are named after the two timestamps they span:
+    + rx_to_conv: advertisement received until Conv processed it
+    + conv_to_ant / conv_to_ble: Conv until the first transmit of that reading
+    + rx_to_ant / rx_to_ble: end to end, what a watch sees
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self) -> None:
+        self.histograms = {}
+        # missed transmit deadlines by (schedule, bike)
+        self.missed = {}
+        # last time to first transmit and number of (re)starts by (output, bike)
+        self.first_tx = {}
+
+    def observe(self, stage, bike_id, seconds):
+        key = (stage, bike_id)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def observe_tx(self, output, bike_data, now):
+        """Records a transmit of `bike_data`, once per Conv reading"""
+        bike_id = bike_data.bike_id
+        self.observe("conv_to_" + output, bike_id, now - bike_data.conv_time)
+        self.observe("rx_to_" + output, bike_id, now - bike_data.rx_time)
+
+    def observe_missed(self, schedule, bike_id, missed):
+        key = (schedule, bike_id)
+        self.missed[key] = self.missed.get(key, 0) + missed
+
+    def observe_first_tx(self, output, bike_id, seconds):
+        """Records how long an output took from (re)starting to its first transmit"""
+        key = (output, bike_id)
+        starts = self.first_tx.get(key, (0, 0))[1]
+        self.first_tx[key] = (seconds, starts + 1)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = [
+            "# HELP keiser_stage_latency_seconds Latency between pipeline stages",
+            "# TYPE keiser_stage_latency_seconds summary",
+        ]
+        for (stage, bike_id), h in sorted(self.histograms.items()):
+            labels = f'stage="{stage}",bike="{bike_id}"'
+            for q in self.QUANTILES:
+                lines.append(
+                    f'keiser_stage_latency_seconds{{{labels},quantile="{q}"}} '
+                    f"{h.percentile(q):.6f}"
+                )
+            lines.append(f"keiser_stage_latency_seconds_sum{{{labels}}} {h.sum:.6f}")
+            lines.append(f"keiser_stage_latency_seconds_count{{{labels}}} {h.count}")
+        lines.append("# TYPE keiser_stage_latency_max_seconds gauge")
+        for (stage, bike_id), h in sorted(self.histograms.items()):
+            lines.append(
+                f'keiser_stage_latency_max_seconds{{stage="{stage}",bike="{bike_id}"}} '
+                f"{h.max:.6f}"
+            )
+        lines.append("# TYPE keiser_tx_missed_deadlines_total counter")
+        for (schedule, bike_id), missed in sorted(self.missed.items()):
+            lines.append(
+                f'keiser_tx_missed_deadlines_total{{schedule="{schedule}",bike="{bike_id}"}} '
+                f"{missed}"
+            )
+        lines.append("# TYPE keiser_tx_time_to_first_tx_seconds gauge")
+        for (output, bike_id), (seconds, _) in sorted(self.first_tx.items()):
+            lines.append(
+                f'keiser_tx_time_to_first_tx_seconds{{output="{output}",bike="{bike_id}"}} '
+                f"{seconds:.6f}"
+            )
+        lines.append("# TYPE keiser_tx_starts_total counter")
+        for (output, bike_id), (_, starts) in sorted(self.first_tx.items()):
+            lines.append(
+                f'keiser_tx_starts_total{{output="{output}",bike="{bike_id}"}} {starts}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        lines = []
+        for (stage, bike_id), h in sorted(self.histograms.items()):
+            lines.append(
+                f"bike {bike_id!s:>4} {stage:11s} n={h.count:6d} "
+                f"p50 {h.percentile(0.5) * 1e3:6.1f} ms "
+                f"p99 {h.percentile(0.99) * 1e3:6.1f} ms "
+                f"max {h.max * 1e3:6.1f} ms"
+            )
+        return "\n".join(lines)
+
+    async def handle(self, reader, writer):
+        try:
+            # the request itself does not matter, every path gets the metrics
+            while (await reader.readline()).strip():
+                pass
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=9108):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def summary_loop(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            if self.histograms:
+                log.info("latency summary\n%s", self.summary())
@@ -0,0 +1,36 @@
+"""One status line per bike at a fixed rate, instead of a line per transmit"""
+
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class StatusReporter:
+    def __init__(self, convs, interval=5.0) -> None:
+        # tx.conv.Conv of every bike, one line each
+        self.convs = convs
+        self.interval = interval
+
+    def report(self):
+        for conv in self.convs:
+            if conv.no_data:
+                log.info("bike %3d no data", conv.bike_id)
+                continue
+            log.info(
+                "bike %3d %4d W 3 s %4d W NP %4d W %3d rpm %5.1f km/h %3d bpm %7.2f km seq %d",
+                conv.bike_id,
+                conv.power,
+                conv.rolling.averages[3],
+                conv.rolling.normalized_power,
+                conv.cadence,
+                conv.speed * 3.6,
+                conv.heart_rate,
+                conv.distance,
+                conv.seq,
+            )
+
+    async def loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
@@ -0,0 +1,84 @@
+"""Event loop lag watchdog
+
+A task on the loop wakes up every `interval` and measures how late it was, that is the scheduling lag every other task sees as well. A thread next to the loop watches the heartbeat of that task: once it is older than `threshold` the loop is stuck in a blocking call, and the thread samples the stack of the loop thread and the task that is running, while it is still stuck.
+"""
+
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from bike import clock
+
+log = logging.getLogger(__name__)
+
+Stall = collections.namedtuple("Stall", ["start", "task", "stack", "duration"])
+
+
+class LoopWatchdog:
+    def __init__(self, interval=0.05, threshold=0.2, metrics=None) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        # optional monitor.metrics.Metrics, gets the lag as stage loop_lag
+        self.metrics = metrics
+
+        self.event_loop = None
+        self.loop_thread = None
+        self.beat = clock()
+        self.max_lag = 0.0
+        # most recent stalls, the one in progress is completed by the loop task
+        self.stalls = collections.deque(maxlen=16)
+        self.stalled = None
+        self.thread = None
+
+    def sample(self):
+        """Stack of the loop thread and the task it is running, called from the watchdog thread"""
+        task = asyncio.current_task(self.event_loop)
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        name = "-" if task is None else f"{task.get_name()} {task.get_coro()!r}"
+        return Stall(self.beat, name, stack, None)
+
+    def watch(self):
+        while True:
+            now = clock()
+            if self.stalled is None and now - self.beat > self.threshold:
+                self.stalled = self.sample()
+                log.warning(
+                    "event loop stalled for %.3f s in task %s\n%s",
+                    now - self.beat,
+                    self.stalled.task,
+                    self.stalled.stack,
+                )
+            # the heartbeat is not fresher than the interval anyway
+            time.sleep(self.interval)
+
+    def tick(self, now, lag):
+        if self.metrics is not None:
+            self.metrics.observe("loop_lag", "loop", lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+        stalled = self.stalled
+        if stalled is not None:
+            duration = now - stalled.start
+            self.stalls.append(stalled._replace(duration=duration))
+            log.warning("event loop resumed after %.3f s", duration)
+            self.stalled = None
+        self.beat = now
+
+    async def loop(self):
+        self.event_loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.beat = clock()
+        self.thread = threading.Thread(
+            target=self.watch, name="loop-watchdog", daemon=True
+        )
+        self.thread.start()
+        while True:
+            deadline = clock() + self.interval
+            await asyncio.sleep(self.interval)
+            now = clock()
+            self.tick(now, max(now - deadline, 0.0))
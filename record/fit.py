@@ -0,0 +1,478 @@
+"""Streaming FIT activity files, one per bike and session
+
+Memory does not grow with the session: records go into a small buffer that is handed to a writer thread whenever it fills up, and the summary messages at the end are built from running sums and maxima.
+
+The FIT header holds the size of the data and its own CRC, and the file CRC covers header and data. Neither is known before the end, so the header is written as a placeholder and the writer thread keeps the CRC of the data alone. At the end the real header is written over the placeholder and the file CRC is the header CRC combined with the data CRC, without reading the file again.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import struct
+import time
+
+from bike import clock
+
+log = logging.getLogger(__name__)
+
+FIT_HEADER = struct.Struct("<BBHI4sH")
+FIT_PROTOCOL_VERSION = 0x20
+FIT_PROFILE_VERSION = 2132
+# FIT timestamps count seconds from 1989-12-31 00:00 UTC
+FIT_EPOCH = 631065600
+
+# base types
+FIT_ENUM = 0x00
+FIT_UINT8 = 0x02
+FIT_UINT16 = 0x84
+FIT_UINT32 = 0x86
+FIT_UINT32Z = 0x8C
+FIT_BASE_TYPES = {
+    FIT_ENUM: "B",
+    FIT_UINT8: "B",
+    FIT_UINT16: "H",
+    FIT_UINT32: "I",
+    FIT_UINT32Z: "I",
+}
+
+FIT_TIMESTAMP = 253
+FIT_EVENT_TIMER = 0
+FIT_EVENT_SESSION = 8
+FIT_EVENT_LAP = 9
+FIT_EVENT_ACTIVITY = 26
+FIT_EVENT_TYPE_START = 0
+FIT_EVENT_TYPE_STOP = 1
+FIT_EVENT_TYPE_STOP_ALL = 4
+FIT_FILE_ACTIVITY = 4
+FIT_MANUFACTURER_DEVELOPMENT = 255
+FIT_SPORT_CYCLING = 2
+FIT_SUB_SPORT_INDOOR_CYCLING = 6
+
+# CRC-16 of the FIT SDK: reflected polynomial 0xA001, starts at 0, no final xor
+FIT_CRC_POLY = 0xA001
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (FIT_CRC_POLY if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+FIT_CRC_TABLE = _crc_table()
+
+
+def crc16(data, crc=0):
+    table = FIT_CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def _gf2_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, row) for row in mat]
+
+
+def crc16_combine(crc1, crc2, len2):
+    """CRC of A + B from the CRCs of A and B and the length of B, as zlib's crc32_combine
+
+    The CRC is linear, so the CRC of A + B is the CRC of A run through len2 zero bytes, xored with the CRC of B. Running through zero bytes is a 16x16 matrix over GF(2), raised to the power of the number of bits by squaring.
+    """
+    if len2 == 0:
+        return crc1
+    # one zero bit
+    odd = [FIT_CRC_POLY] + [1 << n for n in range(15)]
+    even = _gf2_square(odd)  # two
+    odd = _gf2_square(even)  # four
+    while True:
+        even = _gf2_square(odd)  # a byte, doubling every round
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+def fit_time(unix_time):
+    return int(unix_time) - FIT_EPOCH
+
+
+class FitMessage:
+    """A global message with a fixed set of fields, bound to a local message type
+
+    `definition` is the definition message, `pack` packs the data message of the values in field order.
+    """
+
+    def __init__(self, local, number, fields) -> None:
+        self.local = local
+        self.struct = struct.Struct(
+            "<B" + "".join(FIT_BASE_TYPES[base] for _, _, base in fields)
+        )
+        self.definition = struct.pack(
+            "<BBBHB", 0x40 | local, 0, 0, number, len(fields)
+        ) + b"".join(
+            struct.pack("<BBB", num, struct.calcsize(FIT_BASE_TYPES[base]), base)
+            for num, _, base in fields
+        )
+
+    def pack(self, *values):
+        return self.struct.pack(self.local, *values)
+
+
+FIT_FILE_ID = FitMessage(
+    0,
+    0,
+    [
+        (0, "type", FIT_ENUM),
+        (1, "manufacturer", FIT_UINT16),
+        (2, "product", FIT_UINT16),
+        (3, "serial_number", FIT_UINT32Z),
+        (4, "time_created", FIT_UINT32),
+    ],
+)
+FIT_EVENT = FitMessage(
+    1,
+    21,
+    [
+        (FIT_TIMESTAMP, "timestamp", FIT_UINT32),
+        (0, "event", FIT_ENUM),
+        (1, "event_type", FIT_ENUM),
+    ],
+)
+FIT_RECORD = FitMessage(
+    2,
+    20,
+    [
+        (FIT_TIMESTAMP, "timestamp", FIT_UINT32),
+        (3, "heart_rate", FIT_UINT8),  # bpm
+        (4, "cadence", FIT_UINT8),  # rpm
+        (5, "distance", FIT_UINT32),  # cm
+        (6, "speed", FIT_UINT16),  # mm/s
+        (7, "power", FIT_UINT16),  # W
+    ],
+)
+# fields shared by lap and session, in this order after the message specific ones
+FIT_SUMMARY_FIELDS = [
+    (FIT_TIMESTAMP, "timestamp", FIT_UINT32),
+    (0, "event", FIT_ENUM),
+    (1, "event_type", FIT_ENUM),
+    (2, "start_time", FIT_UINT32),
+    (7, "total_elapsed_time", FIT_UINT32),  # ms
+    (8, "total_timer_time", FIT_UINT32),  # ms
+    (9, "total_distance", FIT_UINT32),  # cm
+    (11, "total_calories", FIT_UINT16),  # kcal
+]
+FIT_LAP = FitMessage(
+    3,
+    19,
+    FIT_SUMMARY_FIELDS
+    + [
+        (13, "avg_speed", FIT_UINT16),
+        (14, "max_speed", FIT_UINT16),
+        (15, "avg_heart_rate", FIT_UINT8),
+        (16, "max_heart_rate", FIT_UINT8),
+        (17, "avg_cadence", FIT_UINT8),
+        (18, "max_cadence", FIT_UINT8),
+        (19, "avg_power", FIT_UINT16),
+        (20, "max_power", FIT_UINT16),
+    ],
+)
+FIT_SESSION = FitMessage(
+    4,
+    18,
+    FIT_SUMMARY_FIELDS
+    + [
+        (14, "avg_speed", FIT_UINT16),
+        (15, "max_speed", FIT_UINT16),
+        (16, "avg_heart_rate", FIT_UINT8),
+        (17, "max_heart_rate", FIT_UINT8),
+        (18, "avg_cadence", FIT_UINT8),
+        (19, "max_cadence", FIT_UINT8),
+        (20, "avg_power", FIT_UINT16),
+        (21, "max_power", FIT_UINT16),
+        (5, "sport", FIT_ENUM),
+        (6, "sub_sport", FIT_ENUM),
+        (25, "first_lap_index", FIT_UINT16),
+        (26, "num_laps", FIT_UINT16),
+    ],
+)
+FIT_ACTIVITY = FitMessage(
+    5,
+    34,
+    [
+        (FIT_TIMESTAMP, "timestamp", FIT_UINT32),
+        (0, "total_timer_time", FIT_UINT32),  # ms
+        (1, "num_sessions", FIT_UINT16),
+        (2, "type", FIT_ENUM),
+        (3, "event", FIT_ENUM),
+        (4, "event_type", FIT_ENUM),
+        (5, "local_timestamp", FIT_UINT32),
+    ],
+)
+
+# FIT files of all bikes are written by this one thread, which keeps the chunks
+# of a file and its final header in submission order
+FIT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="fit")
+
+
+class FitWriter:
+    """Appends FIT messages to a file through a buffer written by FIT_EXECUTOR"""
+
+    def __init__(self, path, buffer_size=4096, executor=FIT_EXECUTOR) -> None:
+        self.path = path
+        self.buffer_size = buffer_size
+        self.executor = executor
+        self.buf = bytearray()
+        self.defined = set()
+        # bytes handed to the executor, and their CRC as far as it has written them
+        self.data_size = 0
+        self.crc = 0
+        self.file = None
+        # the first write that failed, the file is lost from there on
+        self.error = None
+        self.last = self.submit(self.open)
+
+    def submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self.check)
+        return future
+
+    def check(self, future):
+        # on the executor thread, only the first failure is logged
+        e = future.exception()
+        if e is not None and self.error is None:
+            self.error = e
+            log.error("writing %s failed: %s", self.path, e)
+
+    def open(self):
+        self.file = open(self.path, "wb")
+        self.file.write(bytes(FIT_HEADER.size))
+
+    def write(self, message, *values):
+        if message.local not in self.defined:
+            self.buf += message.definition
+            self.defined.add(message.local)
+        self.buf += message.pack(*values)
+        if len(self.buf) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return self.last
+        chunk = bytes(self.buf)
+        self.buf.clear()
+        self.data_size += len(chunk)
+        self.last = self.submit(self.write_chunk, chunk)
+        return self.last
+
+    def write_chunk(self, chunk):
+        self.crc = crc16(chunk, self.crc)
+        self.file.write(chunk)
+
+    def close(self):
+        """Flushes and completes the file, returns a concurrent.futures.Future of that"""
+        self.flush()
+        self.last = self.submit(self.finish, self.data_size)
+        return self.last
+
+    def finish(self, data_size):
+        header = FIT_HEADER.pack(
+            FIT_HEADER.size,
+            FIT_PROTOCOL_VERSION,
+            FIT_PROFILE_VERSION,
+            data_size,
+            b".FIT",
+            0,
+        )
+        header = header[:-2] + struct.pack("<H", crc16(header[:-2]))
+        crc = crc16_combine(crc16(header), self.crc, data_size)
+        self.file.write(struct.pack("<H", crc))
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+
+
+class FitSession:
+    """Running totals of one session, all a lap or session message needs"""
+
+    def __init__(self, start, distance, calories) -> None:
+        self.start = start
+        self.start_distance = distance
+        self.start_calories = calories
+        self.count = 0
+        self.sums = [0, 0, 0, 0]
+        self.maxs = [0, 0, 0, 0]
+
+    def add(self, speed, heart_rate, cadence, power):
+        self.count += 1
+        for i, value in enumerate((speed, heart_rate, cadence, power)):
+            self.sums[i] += value
+            if value > self.maxs[i]:
+                self.maxs[i] = value
+
+    def summary(self):
+        """avg and max of speed, heart rate, cadence and power, in that order"""
+        count = max(self.count, 1)
+        values = []
+        for total, peak in zip(self.sums, self.maxs):
+            values += [round(total / count), peak]
+        return values
+
+
+class FitRecorder:
+    """Records the readings of a Conv into one FIT activity per session
+
+    Add it to the listeners of the bike's Conv and run `loop`. A session starts with the first reading and ends once the bike was idle for `idle` seconds, or with `close`. The file is complete as soon as the session ends.
+    """
+
+    def __init__(self, directory, bike_id, idle=300, interval=1.0) -> None:
+        # fail at start up rather than lose the whole session on the writer thread
+        os.makedirs(directory, exist_ok=True)
+        if not os.access(directory, os.W_OK | os.X_OK):
+            raise PermissionError(f"{directory} is not writable")
+        self.directory = directory
+        self.bike_id = bike_id
+        self.idle = idle
+        # seconds between records
+        self.interval = interval
+
+        self.writer = None
+        self.session = None
+        self.last_record = float("-inf")
+        self.last_time = 0
+        self.last_values = None
+
+    def __call__(self, conv):
+        self.record(conv)
+
+    def start(self, conv, now):
+        path = os.path.join(
+            self.directory,
+            time.strftime(f"bike{self.bike_id}-%Y%m%d-%H%M%S.fit", time.localtime(now)),
+        )
+        log.info("bike %d: recording %s", self.bike_id, path)
+        self.writer = FitWriter(path)
+        self.session = FitSession(fit_time(now), conv.distance, conv.calories)
+        self.writer.write(
+            FIT_FILE_ID,
+            FIT_FILE_ACTIVITY,
+            FIT_MANUFACTURER_DEVELOPMENT,
+            0,
+            self.bike_id + 1,
+            self.session.start,
+        )
+        self.writer.write(
+            FIT_EVENT, self.session.start, FIT_EVENT_TIMER, FIT_EVENT_TYPE_START
+        )
+
+    def record(self, conv):
+        now = clock()
+        if now - self.last_record < self.interval:
+            return
+        self.last_record = now
+        wall = time.time()
+        if self.writer is None:
+            self.start(conv, wall)
+
+        timestamp = fit_time(wall)
+        speed = int(conv.speed * 1000) & 0xFFFF
+        heart_rate = int(conv.heart_rate) & 0xFF
+        cadence = int(conv.cadence) & 0xFF
+        power = int(conv.power) & 0xFFFF
+        # the bike may have started a new workout of its own meanwhile
+        distance = max(int((conv.distance - self.session.start_distance) * 1e5), 0)
+        self.session.add(speed, heart_rate, cadence, power)
+        self.writer.write(
+            FIT_RECORD, timestamp, heart_rate, cadence, distance, speed, power
+        )
+        self.last_time = timestamp
+        calories = max(int(conv.calories - self.session.start_calories), 0)
+        self.last_values = (distance, calories)
+
+    def stop(self):
+        """Ends the session with its lap, session and activity messages"""
+        if self.writer is None:
+            return None
+        session = self.session
+        end = self.last_time
+        elapsed = (end - session.start) * 1000
+        distance, calories = self.last_values
+        summary = session.summary()
+        totals = [elapsed, elapsed, distance, calories & 0xFFFF]
+        self.writer.write(FIT_EVENT, end, FIT_EVENT_TIMER, FIT_EVENT_TYPE_STOP_ALL)
+        self.writer.write(
+            FIT_LAP,
+            end,
+            FIT_EVENT_LAP,
+            FIT_EVENT_TYPE_STOP,
+            session.start,
+            *totals,
+            *summary,
+        )
+        self.writer.write(
+            FIT_SESSION,
+            end,
+            FIT_EVENT_SESSION,
+            FIT_EVENT_TYPE_STOP,
+            session.start,
+            *totals,
+            *summary,
+            FIT_SPORT_CYCLING,
+            FIT_SUB_SPORT_INDOOR_CYCLING,
+            0,
+            1,
+        )
+        local_end = end + time.localtime(end + FIT_EPOCH).tm_gmtoff
+        self.writer.write(
+            FIT_ACTIVITY,
+            end,
+            elapsed,
+            1,
+            0,
+            FIT_EVENT_ACTIVITY,
+            FIT_EVENT_TYPE_STOP,
+            local_end,
+        )
+        log.info("bike %d: session of %d s recorded", self.bike_id, elapsed // 1000)
+        done = self.writer.close()
+        self.writer = None
+        self.session = None
+        self.last_record = float("-inf")
+        return done
+
+    async def loop(self):
+        """Ends the session once the bike is idle"""
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.writer is None:
+                continue
+            if clock() - self.last_record > self.idle:
+                self.stop()
+
+    def close(self):
+        done = self.stop()
+        if done is not None:
+            # waits for the file, a failure was logged already
+            done.exception()
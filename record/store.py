@@ -0,0 +1,281 @@
+"""Append-only column store of every bike's history, with 1 s and 1 min rollups
+
+Layout: `root/bike<N>/<YYYYMMDD>/<level>.<column>`, a segment directory per bike and UTC day, one file per column of fixed width little endian values. Levels are `raw` (every Conv reading), `1s` and `1m`. Columns are only ever appended to, a reader memory maps them and uses the common length, so a write cut short leaves a valid store.
+
+The rollups hold additive aggregates (counts, sums, maxima) so any range of them combines into the same numbers the raw samples would give. Normalized power needs the 30 s rolling average of the power in every second, which is computed as the samples come in: each second carries that average to the 4th power, NP of a range is the 4th root of their mean.
+"""
+
+import array
+import asyncio
+import concurrent.futures
+import os
+import time
+
+# name, array typecode, numpy dtype
+RAW_COLUMNS = (
+    ("time", "d", "<f8"),
+    ("power", "H", "<u2"),
+    ("cadence", "f", "<f4"),
+    ("speed", "f", "<f4"),
+    ("heart_rate", "B", "u1"),
+)
+ROLLUP_COLUMNS = (
+    ("time", "q", "<i8"),  # start of the bucket
+    ("count", "I", "<u4"),  # raw samples
+    ("seconds", "I", "<u4"),  # seconds with samples, the weight of np4_sum
+    ("power_sum", "d", "<f8"),
+    ("power_max", "H", "<u2"),
+    ("cadence_sum", "d", "<f8"),
+    ("cadence_max", "f", "<f4"),
+    ("np4_sum", "d", "<f8"),
+)
+STORE_LEVELS = {"raw": RAW_COLUMNS, "1s": ROLLUP_COLUMNS, "1m": ROLLUP_COLUMNS}
+# seconds of the rolling average normalized power is based on
+NP_WINDOW = 30
+
+# a single writer thread shared by all bikes, so the appends to each column
+# file stay in order
+STORE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="store")
+
+
+def segment_name(t):
+    return time.strftime("%Y%m%d", time.gmtime(t))
+
+
+class Rollup:
+    """Aggregates of the bucket being filled, appended to `columns` when it is complete"""
+
+    def __init__(self, columns) -> None:
+        self.columns = columns
+        self.start = None
+
+    def reset(self, start):
+        self.start = start
+        self.count = 0
+        self.seconds = 0
+        self.power_sum = 0.0
+        self.power_max = 0
+        self.cadence_sum = 0.0
+        self.cadence_max = 0.0
+        self.np4_sum = 0.0
+
+    def add(self, count, seconds, power_sum, power_max, cadence_sum, cadence_max, np4):
+        self.count += count
+        self.seconds += seconds
+        self.power_sum += power_sum
+        self.power_max = max(self.power_max, power_max)
+        self.cadence_sum += cadence_sum
+        self.cadence_max = max(self.cadence_max, cadence_max)
+        self.np4_sum += np4
+
+    def emit(self):
+        values = (
+            self.start,
+            self.count,
+            self.seconds,
+            self.power_sum,
+            self.power_max,
+            self.cadence_sum,
+            self.cadence_max,
+            self.np4_sum,
+        )
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+        return values
+
+
+class StoreWriter:
+    """Appends the readings of one bike's Conv, add it to the Conv's listeners"""
+
+    def __init__(self, root, bike_id, executor=STORE_EXECUTOR) -> None:
+        self.root = root
+        self.bike_id = bike_id
+        self.executor = executor
+        self.segment = None
+        # latest sample time, a wall clock step back must not unsort the columns
+        self.last_time = float("-inf")
+        self.buffers = {}
+        self.new_buffers()
+
+        self.second = Rollup(self.buffers["1s"])
+        self.minute = Rollup(self.buffers["1m"])
+        # average power of the last NP_WINDOW seconds with samples
+        self.window = [0.0] * NP_WINDOW
+        self.window_sum = 0.0
+        self.window_len = 0
+        self.window_pos = 0
+
+    def new_buffers(self):
+        for level, columns in STORE_LEVELS.items():
+            self.buffers[level] = {name: array.array(code) for name, code, _ in columns}
+
+    def __call__(self, conv):
+        self.append(time.time(), conv.power, conv.cadence, conv.speed, conv.heart_rate)
+
+    def append(self, t, power, cadence, speed, heart_rate):
+        # queries binary search the time column, held still until the clock catches up
+        t = max(t, self.last_time)
+        self.last_time = t
+        segment = segment_name(t)
+        if segment != self.segment:
+            if self.segment is not None:
+                self.close_buckets()
+                self.flush()
+            self.segment = segment
+
+        power = min(int(power), 0xFFFF)
+        raw = self.buffers["raw"]
+        for name, value in zip(
+            ("time", "power", "cadence", "speed", "heart_rate"),
+            (t, power, cadence, speed, min(int(heart_rate), 0xFF)),
+        ):
+            raw[name].append(value)
+
+        second = int(t)
+        if self.second.start is not None and second != self.second.start:
+            self.close_second()
+        if self.second.start is None:
+            self.second.reset(second)
+        self.second.add(1, 0, power, power, cadence, cadence, 0.0)
+
+    def close_second(self):
+        s = self.second
+        # 30 s rolling average over the average power of every second
+        average = s.power_sum / s.count
+        if self.window_len < NP_WINDOW:
+            self.window_len += 1
+        self.window_sum += average - self.window[self.window_pos]
+        self.window[self.window_pos] = average
+        self.window_pos = (self.window_pos + 1) % NP_WINDOW
+        np4 = (self.window_sum / self.window_len) ** 4
+        s.seconds = 1
+        s.np4_sum = np4
+        values = s.emit()
+
+        minute = s.start - s.start % 60
+        if self.minute.start is not None and minute != self.minute.start:
+            self.minute.emit()
+            self.minute.start = None
+        if self.minute.start is None:
+            self.minute.reset(minute)
+        self.minute.add(*values[1:])
+        s.start = None
+
+    def close_buckets(self):
+        """Completes the buckets in progress, at the end of a segment or at exit"""
+        if self.second.start is not None:
+            self.close_second()
+        if self.minute.start is not None:
+            self.minute.emit()
+            self.minute.start = None
+
+    def flush(self):
+        """Hands the buffered columns to the executor, returns its Future"""
+        buffers = self.buffers
+        self.buffers = {}
+        self.new_buffers()
+        self.second.columns = self.buffers["1s"]
+        self.minute.columns = self.buffers["1m"]
+        directory = os.path.join(self.root, f"bike{self.bike_id}", self.segment)
+        return self.executor.submit(self.write, directory, buffers)
+
+    @staticmethod
+    def write(directory, buffers):
+        os.makedirs(directory, exist_ok=True)
+        for level, columns in buffers.items():
+            for name, values in columns.items():
+                if not values:
+                    continue
+                with open(os.path.join(directory, f"{level}.{name}"), "ab") as f:
+                    values.tofile(f)
+
+    async def loop(self, interval=10):
+        """Writes the buffers out every `interval` seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.segment is not None:
+                self.flush()
+
+    def close(self):
+        if self.segment is None:
+            return
+        self.close_buckets()
+        self.flush().result()
+
+
+class Store:
+    """Range queries over the segments of a store, memory mapped"""
+
+    def __init__(self, root) -> None:
+        self.root = root
+
+    def bikes(self):
+        return sorted(
+            int(name[4:]) for name in os.listdir(self.root) if name.startswith("bike")
+        )
+
+    def load_segment(self, directory, level):
+        import numpy as np
+
+        columns = {}
+        for name, _, dtype in STORE_LEVELS[level]:
+            path = os.path.join(directory, f"{level}.{name}")
+            # a value cut short at the end is left out
+            count = (
+                os.path.getsize(path) // np.dtype(dtype).itemsize
+                if os.path.exists(path)
+                else 0
+            )
+            if count == 0:
+                return None
+            columns[name] = np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+        # a column may be ahead of the others after an interrupted write
+        length = min(len(c) for c in columns.values())
+        return {name: c[:length] for name, c in columns.items()}
+
+    def query(self, bike_id, start, end, level="1m"):
+        """Columns of `level` with start <= time < end, as NumPy arrays, empty for a bike without history"""
+        import numpy as np
+
+        bike_dir = os.path.join(self.root, f"bike{bike_id}")
+        first, last = segment_name(start), segment_name(end)
+        parts = []
+        segments = os.listdir(bike_dir) if os.path.isdir(bike_dir) else []
+        for segment in sorted(segments):
+            if not first <= segment <= last:
+                continue
+            columns = self.load_segment(os.path.join(bike_dir, segment), level)
+            if columns is None:
+                continue
+            times = columns["time"]
+            lo, hi = np.searchsorted(times, [start, end])
+            if hi > lo:
+                parts.append({name: c[lo:hi] for name, c in columns.items()})
+        return {
+            name: (
+                np.concatenate([p[name] for p in parts])
+                if parts
+                else np.empty(0, dtype)
+            )
+            for name, _, dtype in STORE_LEVELS[level]
+        }
+
+    def summary(self, bike_id, start, end, level="1m"):
+        """Average and maximum power and cadence and normalized power over a range
+
+        Only whole buckets of `level` are counted, use 1s for ranges that do not fall on minutes.
+        """
+        c = self.query(bike_id, start, end, level)
+        count = int(c["count"].sum())
+        seconds = int(c["seconds"].sum())
+        if count == 0:
+            return None
+        return {
+            "samples": count,
+            "seconds": seconds,
+            "avg_power": float(c["power_sum"].sum()) / count,
+            "max_power": int(c["power_max"].max()),
+            "avg_cadence": float(c["cadence_sum"].sum()) / count,
+            "max_cadence": float(c["cadence_max"].max()),
+            "normalized_power": (float(c["np4_sum"].sum()) / seconds) ** 0.25,
+        }
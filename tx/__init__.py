@@ -38,16 +38,13 @@ class CountGenerator:
         #     self.notify = False
 
 
-def power_to_speed(power):
+def power_to_speed(power, mass=75, Cd=0.9, A=0.5, rho=1.225, Crr=0.0045):
     """
     power in watts
     speed in m/s
+    mass of rider and bike in kg
     """
-    Cd = 0.9
-    A = 0.5
-    rho = 1.225
-    Crr = 0.0045
-    F_gravity = 75 * 9.81
+    F_gravity = mass * 9.81
 
     # Define the power equations
     coeff_P_drag = 0.5 * Cd * A * rho  # * v**3
@@ -1,148 +1,643 @@
 import usb
-import struct
-import time
 import asyncio
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
 
-from ant.core import driver, node, message, constants, resetUSB
+from ant.core import driver, node, message, constants
 
+from bike import clock
+from .codec import (
+    ANT_FE_GENERAL_PAGE_ID,
+    ANT_FE_SETTINGS_PAGE_ID,
+    ANT_FE_TRAINER_PAGE_ID,
+    ANT_MANUFACTURER_DEVELOPMENT,
+    ANT_MANUFACTURER_INFO_PAGE_ID,
+    ANT_PRODUCT_INFO_PAGE_ID,
+    ANTFEGeneralPage,
+    ANTFESettingsPage,
+    ANTFETrainerPage,
+    ANTManufacturerInfoPage,
+    ANTProductInfoPage,
+    ANTPowerPage,
+    ANTSpeedPage,
+)
+from .sched import ANT_PERIOD_UNIT, PeriodicSchedule
 
-class ANTTx:
-    def __init__(self):
-        devs = usb.core.find(find_all=True, idVendor=0x0FCF)
-        for dev in devs:
-            if dev.idProduct in [0x1008, 0x1009]:
-                resetUSB.reset_USB_Device()
-                time.sleep(1)
-                stick = driver.USB2Driver(
-                    log=None,
-                    debug=False,
-                    idProduct=dev.idProduct,
-                    bus=dev.bus,
-                    address=dev.address,
-                )
-                try:
-                    print("found stick, opening...")
-                    stick.open()
-                except:
-                    print("failed to open stick, trying next")
+log = logging.getLogger(__name__)
+
+ANT_VENDOR_ID = 0x0FCF
+ANT_PRODUCT_IDS = [0x1008, 0x1009]
+
+SPEED_DEVICE_TYPE = 0x7B  # 8118
+# CADENCE_DEVICE_TYPE = 0x7A # 8102
+# SPEED_CADENCE_DEVICE_TYPE = 0x79  # 8086
+FITNESS_EQUIPMENT_DEVICE_TYPE = 0x11
+POWER_DEVICE_TYPE = 0x0B
+# device number of bike 0, bike N uses SENSOR_ID + N
+SENSOR_ID = 3862
+# sent in the common manufacturer and product information pages
+ANT_HW_REVISION = 1
+ANT_MODEL_NUMBER = 1
+ANT_SW_REVISION = 1
+
+
+def find_sticks():
+    """Every ANT USB stick plugged in, keyed by (bus, address)"""
+    devs = usb.core.find(find_all=True, idVendor=ANT_VENDOR_ID)
+    return {
+        (dev.bus, dev.address): dev for dev in devs if dev.idProduct in ANT_PRODUCT_IDS
+    }
+
+
+def open_stick_node(dev):
+    """Opens an ANT USB stick and returns its started node"""
+    stick = driver.USB2Driver(
+        log=None,
+        debug=False,
+        idProduct=dev.idProduct,
+        bus=dev.bus,
+        address=dev.address,
+    )
+    log.info("found stick %d:%d, opening", dev.bus, dev.address)
+    antnode = node.Node(stick)
+    log.debug("starting ANT node")
+    antnode.start()
+    return antnode
+
+
+class ANTWorker(threading.Thread):
+    """Runs every python-ant call of one stick on its own thread
+
+    The event loop only enqueues: control calls go through a bounded queue and return a concurrent.futures.Future, broadcast payloads are coalesced per channel so only the latest one is sent. A stalled USB transfer then only holds up this thread, not the BLE output or the scanner.
+    """
+
+    def __init__(self, antnode, maxsize=32) -> None:
+        super().__init__(name="ant-worker", daemon=True)
+        self.node = antnode
+        self.maxsize = maxsize
+        self.cond = threading.Condition()
+        self.commands = collections.deque()
+        # latest payload by channel number
+        self.pending = {}
+        self.stopping = False
+        self.errors = 0
+        # sends failing back to back, the stick is likely gone
+        self.failures = 0
+        self.max_failures = 8
+        # a control call failed, see ANTStick.call
+        self.broken = False
+
+    def call(self, fn, *args):
+        future = concurrent.futures.Future()
+        with self.cond:
+            if len(self.commands) >= self.maxsize:
+                raise queue.Full("ANT worker queue is full")
+            self.commands.append((future, fn, args))
+            self.cond.notify()
+        return future
+
+    def discard(self, number):
+        """Drops the payload of a channel that was not sent yet"""
+        with self.cond:
+            self.pending.pop(number, None)
+
+    def send(self, number, payload):
+        with self.cond:
+            self.pending[number] = payload
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not (self.commands or self.pending or self.stopping):
+                    self.cond.wait()
+                if self.stopping and not self.commands:
+                    return
+                commands = list(self.commands)
+                self.commands.clear()
+                pending, self.pending = self.pending, {}
+
+            for future, fn, args in commands:
+                if not future.set_running_or_notify_cancel():
                     continue
-                stick.close()
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            for number, payload in pending.items():
+                try:
+                    msg = message.ChannelBroadcastDataMessage(number, data=payload)
+                    self.node.send(msg)
+                    self.failures = 0
+                except Exception as e:
+                    self.errors += 1
+                    self.failures += 1
+                    log.warning("send on channel %d failed: %s", number, e)
+
+    @property
+    def failed(self):
+        return self.broken or self.failures >= self.max_failures or not self.is_alive()
+
+
+class ANTStick:
+    """A started ANT node with the ANT+ network key set, driven by its own ANTWorker"""
+
+    def __init__(self, key, antnode) -> None:
+        self.key = key
+        self.node = antnode
+        self.net_id = node.Network(constants.NETWORK_KEY_ANT_PLUS, "ZZ:ANT+")
+        self.free_numbers = list(range(len(antnode.channels)))
+        self.capacity = len(self.free_numbers)
+        self.users = []
+
+        self.worker = ANTWorker(antnode)
+        self.worker.start()
+        self.call(antnode.setNetworkKey, constants.NETWORK_NUMBER_PUBLIC, self.net_id)
+
+    def call(self, fn, *args):
+        """Queues a control call on the worker
+
+        A call that fails or does not fit in the queue marks the worker failed, the allocator's next scan then drops the stick and moves its bikes, instead of counting them as on air while nothing is sent.
+        """
+        try:
+            future = self.worker.call(fn, *args)
+        except queue.Full as e:
+            log.error("stick %s: %s not queued: %s", self.key, fn.__name__, e)
+            self.worker.broken = True
+            return None
+        future.add_done_callback(lambda f: self.check(fn, f))
+        return future
+
+    def check(self, fn, future):
+        # on the worker thread
+        e = future.exception()
+        if e is not None:
+            log.error("stick %s: %s failed: %s", self.key, fn.__name__, e)
+            self.worker.broken = True
+
+    def free(self):
+        return len(self.free_numbers)
+
+    def open_channel(self, number, device_type, device_number, period):
+        chan = self.node.channels[number]
+        chan.assign(self.net_id, constants.CHANNEL_TYPE_TWOWAY_TRANSMIT)
+        chan.setID(device_type, device_number, 0)
+        chan.period = period
+        chan.frequency = 57
+        chan.open()
+
+    def close_channel(self, number):
+        chan = self.node.channels[number]
+        chan.close()
+        chan.unassign()
+
+    def close(self, timeout=None):
+        """Stops the node and the worker once everything queued is done
+
+        With a `timeout` waits that long for the worker to get there, at exit the daemon thread would otherwise be killed with the channel closes still queued.
+        """
+        self.call(self.node.stop)
+        self.worker.stop()
+        if timeout is not None:
+            self.worker.join(timeout)
+            if self.worker.is_alive():
+                log.warning("stick %s did not stop within %.1f s", self.key, timeout)
+
+
+class ANTChannelAllocator:
+    """Hands out channels of every ANT stick to bike transmitters
+
+    A typical stick has 8 channels and a bike needs 2, so each stick serves 4 bikes. `scan` picks up sticks plugged in or removed: bikes of a lost stick move to free channels elsewhere, bikes left without channels get them as soon as a stick has room again, and a new stick takes bikes over from the fullest ones until the free channels are even. USB enumeration and opening run in a thread, off the event loop.
+    """
+
+    def __init__(self) -> None:
+        self.sticks = {}
+        self.txs = []
+
+    async def open(self):
+        """Opens every stick at once, a stick is only reset if it does not open"""
+        found = await asyncio.to_thread(find_sticks)
+        await asyncio.gather(*(self.open_stick(key, dev) for key, dev in found.items()))
+        if not self.sticks:
+            log.warning("no ANT devices available")
+
+    async def open_stick(self, key, dev, reset=True):
+        try:
+            antnode = await asyncio.to_thread(open_stick_node, dev)
+        except Exception as e:
+            if not reset:
+                log.error("failed to open stick %s: %s", key, e)
+                return
+            log.warning("failed to open stick %s, resetting it: %s", key, e)
+            try:
+                # only this device, the other sticks may be serving bikes already
+                await asyncio.to_thread(dev.reset)
+            except usb.core.USBError as e:
+                log.error("failed to reset stick %s: %s", key, e)
+                return
+            await asyncio.sleep(1)
+            # re-enumerated, and it may come back under a new address the next scan finds
+            dev = (await asyncio.to_thread(find_sticks)).get(key)
+            if dev is not None:
+                await self.open_stick(key, dev, reset=False)
+            return
+        self.add_stick(key, antnode)
+
+    async def scan(self):
+        """Drops sticks that are gone or failing and opens new ones"""
+        found = await asyncio.to_thread(find_sticks)
+        for key, stick in list(self.sticks.items()):
+            if key not in found or stick.worker.failed:
+                self.remove_stick(key)
+        new = [(key, dev) for key, dev in found.items() if key not in self.sticks]
+        await asyncio.gather(*(self.open_stick(key, dev, False) for key, dev in new))
+
+    def add_stick(self, key, antnode):
+        stick = self.sticks[key] = ANTStick(key, antnode)
+        log.info("stick %s added, %d channels", key, stick.capacity)
+        self.place()
+        self.rebalance(stick)
+
+    def rebalance(self, stick):
+        """Moves bikes from the fullest sticks to `stick` until the free channels are even"""
+        moved = 0
+        while True:
+            others = [s for s in self.sticks.values() if s is not stick and s.users]
+            if not others:
                 break
-        else:
-            print("No ANT devices available")
-            exit(1)
-        antnode = node.Node(stick)
-        print("Starting ANT node")
-        antnode.start()
-
-        SPEED_DEVICE_TYPE = 0x7B  # 8118
-        # CADENCE_DEVICE_TYPE = 0x7A # 8102
-        # SPEED_CADENCE_DEVICE_TYPE = 0x79  # 8086
-        # FITNESS_EQUIPMENT_DEVICE_TYPE = 0x11
-        POWER_DEVICE_TYPE = 0x0B
-        SENSOR_ID = 3862
-
-        print("Starting CSC/CP with ANT+ ID " + repr(SENSOR_ID))
-        net_id = node.Network(constants.NETWORK_KEY_ANT_PLUS, "ZZ:ANT+")
-        antnode.setNetworkKey(constants.NETWORK_NUMBER_PUBLIC, net_id)
+            fullest = min(others, key=ANTStick.free)
+            tx = fullest.users[-1]
+            # a move narrows the gap only while it is wider than the bike's channels
+            if stick.free() - fullest.free() <= tx.channel_count:
+                break
+            fullest.users.remove(tx)
+            tx.detach()
+            # count the outage until the first transmit on the new stick
+            tx.down_since = clock()
+            stick.users.append(tx)
+            tx.attach(stick)
+            moved += 1
+        if moved:
+            log.info("moved %d bikes to stick %s", moved, stick.key)
+
+    def remove_stick(self, key):
+        stick = self.sticks.pop(key)
+        log.warning("stick %s removed, moving %d bikes", key, len(stick.users))
+        for tx in stick.users:
+            # the device is gone, nothing to close
+            tx.detach(close=False)
+        # not joined, a hung transfer must not hold up the other sticks
+        stick.close()
+        self.place()
+
+    def allocate(self, tx):
+        for other in self.txs:
+            if other.device_number == tx.device_number:
+                raise ValueError(f"ANT device number {tx.device_number} is in use")
+        self.txs.append(tx)
+        self.place()
+
+    def release(self, tx):
+        if tx.stick is not None:
+            tx.stick.users.remove(tx)
+            tx.detach()
+        self.txs.remove(tx)
+        self.place()
+
+    def place(self):
+        """Attaches transmitters without channels to the stick with most room"""
+        unplaced = []
+        for tx in self.txs:
+            if tx.stick is not None:
+                continue
+            sticks = [s for s in self.sticks.values() if s.free() >= tx.channel_count]
+            if not sticks:
+                unplaced.append(tx.device_number)
+                continue
+            stick = max(sticks, key=ANTStick.free)
+            stick.users.append(tx)
+            tx.attach(stick)
+        # without any stick the allocator loop reports that already
+        if unplaced and self.sticks:
+            log.warning("no free channels for devices %s", unplaced)
+
+    def close(self, timeout=2.0):
+        """Closes every channel and stops the sticks, waits up to `timeout` seconds per stick"""
+        # emptied first, release() would place waiting bikes on the sticks being stopped
+        txs, self.txs = self.txs, []
+        for tx in txs:
+            if tx.stick is not None:
+                tx.stick.users.remove(tx)
+                tx.detach()
+        for stick in self.sticks.values():
+            stick.close(timeout)
+        self.sticks.clear()
+
+    async def loop(self, interval=1):
+        """Opens the sticks, then watches for sticks being plugged in, removed or failing"""
+        scan = self.open
+        failing = False
+        while True:
+            try:
+                await scan()
+                scan = self.scan
+                failing = False
+            except (usb.core.USBError, usb.core.NoBackendError) as e:
+                # no libusb or no permission yet, BLE carries on meanwhile
+                level = logging.DEBUG if failing else logging.ERROR
+                log.log(level, "scanning for ANT sticks failed: %s", e)
+                failing = True
+            await asyncio.sleep(interval)
+
 
+class ANTTx:
+    """Bicycle power and bicycle speed, two channels per bike"""
+
+    NAME = "CSC/CP"
+    # attribute, device type and period of every channel a bike uses
+    CHANNELS = [
+        ("p_chan", POWER_DEVICE_TYPE, 8182),
+        ("c_chan", SPEED_DEVICE_TYPE, 8118),
+    ]
+    channel_count = len(CHANNELS)
+
+    def __init__(self, antnode=None, metrics=None, device_number=SENSOR_ID):
+        """Channels are handed out by ANTChannelAllocator, or opened on `antnode` directly (see tx.fake for a stand-in)"""
+        # optional monitor.metrics.Metrics
+        self.metrics = metrics
+        self.device_number = device_number
+
+        self.stick = None
+        # channel numbers on the stick, also set as the CHANNELS attributes
         self.chans = []
+        for attr, _, _ in self.CHANNELS:
+            setattr(self, attr, None)
 
-        p_chan = antnode.getFreeChannel()
-        p_chan.assign(net_id, constants.CHANNEL_TYPE_TWOWAY_TRANSMIT)
-        p_chan.setID(POWER_DEVICE_TYPE, SENSOR_ID, 0)
-        p_chan.period = 8182
-        p_chan.frequency = 57
-        p_chan.open()
-        self.p_chan = p_chan
-        self.chans.append(p_chan)
-
-        c_chan = antnode.getFreeChannel()
-        c_chan.assign(net_id, constants.CHANNEL_TYPE_TWOWAY_TRANSMIT)
-        c_chan.setID(SPEED_DEVICE_TYPE, SENSOR_ID, 0)
-        c_chan.period = 8118
-        c_chan.frequency = 57
-        c_chan.open()
-        self.c_chan = c_chan
-        self.chans.append(c_chan)
-
-        # f_chan = antnode.getFreeChannel()
-        # f_chan.assign(net_id, constants.CHANNEL_TYPE_TWOWAY_TRANSMIT)
-        # f_chan.setID(FITNESS_EQUIPMENT_DEVICE_TYPE, SENSOR_ID, 0)
-        # f_chan.period = 8192
-        # f_chan.frequency = 57
-        # f_chan.open()
-        # self.f_chan = f_chan
-        # self.chans.append(f_chan)
+        self.power_page = ANTPowerPage()
+        self.speed_page = ANTSpeedPage()
 
-        self.node = antnode
+        # when the output went down, until its first transmit
+        self.down_since = clock()
+        # channels closed while the bike is idle, they keep their numbers
+        self.paused = False
+
+        if antnode is not None:
+            self.attach(ANTStick(None, antnode))
+
+    def attach(self, stick):
+        log.info(
+            "starting %s with ANT+ ID %d on stick %s",
+            self.NAME,
+            self.device_number,
+            stick.key,
+        )
+        for attr, _, _ in self.CHANNELS:
+            number = stick.free_numbers.pop(0)
+            self.chans.append(number)
+            setattr(self, attr, number)
+        self.stick = stick
+        if not self.paused:
+            self.open_channels()
+
+    def open_channels(self):
+        for (_, device_type, period), number in zip(self.CHANNELS, self.chans):
+            self.stick.call(
+                self.stick.open_channel, number, device_type, self.device_number, period
+            )
+
+    def detach(self, close=True):
+        if not close:
+            # the stick is gone, count the outage from now
+            self.down_since = clock()
+        for number in self.chans:
+            # the number may go to another bike, which must not send this one's payload
+            self.stick.worker.discard(number)
+            if close and not self.paused:
+                self.stick.call(self.stick.close_channel, number)
+            self.stick.free_numbers.append(number)
+        self.chans = []
+        for attr, _, _ in self.CHANNELS:
+            setattr(self, attr, None)
+        self.stick = None
 
     def send_msg(self, chan, payload):
-        ant_msg = message.ChannelBroadcastDataMessage(chan.number, data=payload)
-        self.node.send(ant_msg)
+        self.stick.worker.send(chan, payload)
+
+    def pause(self):
+        """Closes the channels, an open channel would keep broadcasting the last payload"""
+        if self.paused:
+            return
+        self.paused = True
+        if self.stick is None:
+            return
+        log.info("device %d idle, closing its channels", self.device_number)
+        for number in self.chans:
+            self.stick.worker.discard(number)
+            self.stick.call(self.stick.close_channel, number)
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+        if self.stick is not None:
+            self.open_channels()
+
+    async def idle(self, bike_data, schedule):
+        """Keeps the channels closed while the bike is idle, the next transmit follows its first reading"""
+        self.pause()
+        await bike_data.wait_active()
+        self.resume()
+        schedule.reset()
+
+    def report_first_tx(self, bike_data, now):
+        seconds = now - self.down_since
+        self.down_since = None
+        log.info("device %d: first transmit after %.2f s", self.device_number, seconds)
+        if self.metrics is not None:
+            self.metrics.observe_first_tx("ant", bike_data.bike_id, seconds)
+
+    def report_missed(self, channel, bike_data, missed):
+        log.warning("%s %d: missed %d deadlines", channel, self.device_number, missed)
+        if self.metrics is not None:
+            self.metrics.observe_missed("ant_" + channel, bike_data.bike_id, missed)
+
+    async def power_loop(self, bike_data):
+        schedule = PeriodicSchedule(self.CHANNELS[0][2] * ANT_PERIOD_UNIT)
+        sent_seq = 0
+        while True:
+            missed = await schedule.wait()
+            if missed:
+                self.report_missed("power", bike_data, missed)
+            if bike_data.idle:
+                await self.idle(bike_data, schedule)
+                continue
+            if bike_data.no_data:
+                continue
+            if self.p_chan is None:
+                # waiting for the allocator to find free channels
+                continue
+            payload = self.power_page.encode(
+                bike_data.get_event_count(),
+                bike_data.get_cadence(),
+                bike_data.get_cum_power(),
+                bike_data.get_power(),
+            )
+            self.send_msg(self.p_chan, payload)
+            if self.down_since is not None:
+                self.report_first_tx(bike_data, clock())
+
+            if self.metrics is not None and bike_data.seq != sent_seq:
+                sent_seq = bike_data.seq
+                self.metrics.observe_tx("ant", bike_data, clock())
+
+    async def speed_loop(self, bike_data):
+        schedule = PeriodicSchedule(self.CHANNELS[1][2] * ANT_PERIOD_UNIT)
+        while True:
+            missed = await schedule.wait()
+            if missed:
+                self.report_missed("speed", bike_data, missed)
+            if bike_data.idle:
+                await self.idle(bike_data, schedule)
+                continue
+            if bike_data.no_data or self.c_chan is None:
+                continue
+            payload = self.speed_page.encode(
+                bike_data.get_event_time_ms(),
+                bike_data.get_cum_rev_count(),
+            )
+            self.send_msg(self.c_chan, payload)
+
+    def loops(self, bike_data):
+        return [self.power_loop(bike_data), self.speed_loop(bike_data)]
 
     async def loop(self, bike_data):
         try:
-            while True:
-                await asyncio.sleep(0.25)
-                if bike_data.no_data:
-                    print("ANT: No data")
-                    continue
-                print(
-                    "ANT TX: ",
-                    f"{int(bike_data.get_power()):3d} W {int(bike_data.get_cadence()):3d} RPM {bike_data.get_cum_rev_count():5d} REV "
-                    f"{bike_data.get_event_time_ms():5d} ms {bike_data.speed * 3.6 / 1.67:2.1f} mph",
-                    time.time(),
-                    end="\n",
-                )
-                PWR_PAGE_ID = 0x10
-                payload = struct.pack(
-                    "<BB" + "BB" + "HH",
-                    *[
-                        PWR_PAGE_ID,
-                        bike_data.get_event_count(),
-                        0xFF,  # Pedal power not used
-                        bike_data.get_cadence(),
-                        bike_data.get_cum_power(),
-                        bike_data.get_power(),
-                    ],
-                )
-                self.send_msg(self.p_chan, payload)
-
-                DEFAULT_PAGE_ID = 0x00
-                payload = struct.pack(
-                    "<B" + "BH" + "HH",
-                    DEFAULT_PAGE_ID,
-                    0xFF,
-                    0xFFFF,
-                    bike_data.get_event_time_ms(),
-                    bike_data.get_cum_rev_count(),
-                )
-                self.send_msg(self.c_chan, payload)
-
-                # payload = bytearray(b"\x11")  # General Settings Page
-                # payload.append(0xFF)
-                # payload.append(0xFF)  # Cadence
-                # payload.append(int(5 / 0.01) & 0xFF)
-                # payload.append(0xFF)
-                # payload.append(0x7F)
-                # payload.append(int(kl.resistence * 2) & 0xFF)
-                # payload.append(0x00)  # flags not used
-                # ant_tx.send_f(payload)
-
-                # payload = bytearray(b"\x19")  # FE power
-                # payload.append(bike_data.power_event_counts & 0xFF)
-                # payload.append(int(bike_data.cadence) & 0xFF)  # Cadence
-                # payload.append(bike_data.cum_power & 0xFF)
-                # payload.append(bike_data.cum_power >> 8)
-                # payload.append(bike_data.power & 0xFF)
-                # payload.append((bike_data.power >> 8) & 0x0F)
-                # payload.append(0x00)  # flags not used
-                # ant_tx.send_f(payload)
-
+            async with asyncio.TaskGroup() as g:
+                for coro in self.loops(bike_data):
+                    g.create_task(coro)
         except asyncio.CancelledError:
-            print("Cancelled: Clean Up ANT+ Channels ....")
-            for chan in self.chans:
-                chan.close()
-            self.node.stop()
-            print("Exiting: Finished Cleanup.")
+            log.debug(
+                "cancelled, cleaning up channels of device %d", self.device_number
+            )
+            if self.stick is not None and self.stick.key is None:
+                # opened on a node handed in directly, nobody else stops it
+                stick = self.stick
+                self.detach()
+                stick.close(timeout=2.0)
+            log.debug("device %d cleaned up", self.device_number)
+
+
+class ANTFETx(ANTTx):
+    """ANT+ fitness equipment (FE-C broadcast), one channel per bike
+
+    General FE data, trainer data and general settings take turns on one channel at 4 Hz, so a stick serves twice as many bikes as with separate power and speed channels.
+    """
+
+    NAME = "FE"
+    CHANNELS = [("fe_chan", FITNESS_EQUIPMENT_DEVICE_TYPE, 8192)]
+    channel_count = len(CHANNELS)
+    # trainer data every other message for power, general settings once per rotation
+    PAGES = (
+        ANT_FE_TRAINER_PAGE_ID,
+        ANT_FE_GENERAL_PAGE_ID,
+        ANT_FE_TRAINER_PAGE_ID,
+        ANT_FE_GENERAL_PAGE_ID,
+        ANT_FE_TRAINER_PAGE_ID,
+        ANT_FE_GENERAL_PAGE_ID,
+        ANT_FE_TRAINER_PAGE_ID,
+        ANT_FE_SETTINGS_PAGE_ID,
+    )
+    # the last two messages of every this many are the manufacturer and product
+    # information common pages, which displays look at when pairing
+    COMMON_PAGES_EVERY = 64
+
+    def __init__(self, antnode=None, metrics=None, device_number=SENSOR_ID):
+        self.general_page = ANTFEGeneralPage()
+        self.settings_page = ANTFESettingsPage()
+        self.trainer_page = ANTFETrainerPage()
+        self.manufacturer_page = ANTManufacturerInfoPage()
+        self.product_page = ANTProductInfoPage()
+        super().__init__(antnode, metrics, device_number)
+
+    def encode(self, page, bike_data, elapsed):
+        if page == ANT_FE_TRAINER_PAGE_ID:
+            return self.trainer_page.encode(
+                bike_data.get_event_count(),
+                bike_data.get_cadence(),
+                bike_data.get_cum_power(),
+                bike_data.get_power(),
+            )
+        if page == ANT_FE_GENERAL_PAGE_ID:
+            return self.general_page.encode(
+                int(elapsed * 4),
+                bike_data.get_distance(),
+                bike_data.get_speed(),
+                bike_data.get_heart_rate(),
+            )
+        if page == ANT_FE_SETTINGS_PAGE_ID:
+            return self.settings_page.encode(bike_data.get_resistance())
+        if page == ANT_MANUFACTURER_INFO_PAGE_ID:
+            return self.manufacturer_page.encode(
+                ANT_HW_REVISION, ANT_MANUFACTURER_DEVELOPMENT, ANT_MODEL_NUMBER
+            )
+        # the device number doubles as the serial number
+        return self.product_page.encode(ANT_SW_REVISION, self.device_number)
+
+    def page(self, count):
+        """Page of the `count`th message"""
+        slot = count % self.COMMON_PAGES_EVERY
+        if slot == self.COMMON_PAGES_EVERY - 2:
+            return ANT_MANUFACTURER_INFO_PAGE_ID
+        if slot == self.COMMON_PAGES_EVERY - 1:
+            return ANT_PRODUCT_INFO_PAGE_ID
+        return self.PAGES[count % len(self.PAGES)]
+
+    async def fe_loop(self, bike_data):
+        schedule = PeriodicSchedule(self.CHANNELS[0][2] * ANT_PERIOD_UNIT)
+        sent_seq = 0
+        count = 0
+        # elapsed time counts from the first reading
+        start = None
+        while True:
+            missed = await schedule.wait()
+            if missed:
+                self.report_missed("fe", bike_data, missed)
+            if bike_data.idle:
+                await self.idle(bike_data, schedule)
+                continue
+            if bike_data.no_data:
+                continue
+            if self.fe_chan is None:
+                # waiting for the allocator to find a free channel
+                continue
+            now = clock()
+            if start is None:
+                start = now
+            page = self.page(count)
+            count += 1
+            self.send_msg(self.fe_chan, self.encode(page, bike_data, now - start))
+            if self.down_since is not None:
+                self.report_first_tx(bike_data, now)
+
+            # only the trainer page carries the power of a new reading
+            if page != ANT_FE_TRAINER_PAGE_ID:
+                continue
+            if self.metrics is not None and bike_data.seq != sent_seq:
+                sent_seq = bike_data.seq
+                self.metrics.observe_tx("ant", bike_data, now)
+
+    def loops(self, bike_data):
+        return [self.fe_loop(bike_data)]
+
+
+# output modes, by name
+ANT_MODES = {"cp-csc": ANTTx, "fe": ANTFETx}
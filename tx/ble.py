@@ -1,7 +1,8 @@
 import asyncio
+import logging
 import struct
-import time
 
+from dbus_next import Message, MessageType
 from bluez_peripheral.gatt.service import Service, ServiceCollection
 from bluez_peripheral.gatt.characteristic import (
     characteristic,
@@ -11,6 +12,20 @@ from bluez_peripheral.util import *
 from bluez_peripheral.advert import Advertisement, AdvertisingIncludes
 from bluez_peripheral.agent import NoIoAgent
 
+from bike import clock
+from .sched import PeriodicSchedule
+from .codec import (
+    CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT,
+    CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT,
+    CPMeasurement,
+    CSCMeasurement,
+    CSCCrankMeasurement,
+    CSCWheelMeasurement,
+    FTMSIndoorBikeData,
+)
+
+log = logging.getLogger(__name__)
+
 # cycling speed and cadence
 CSC_UUID = "1816"
 CSC_MEASUREMENT_UUID = "2A5B"
@@ -24,6 +39,11 @@ CP_VECTOR_UUID = "2A64"
 CP_FEATURE_UUID = "2A65"
 CP_CONTROL_POINT_UUID = "2A66"
 
+# fitness machine
+FTMS_UUID = "1826"
+FTMS_FEATURE_UUID = "2ACC"
+FTMS_INDOOR_BIKE_DATA_UUID = "2AD2"
+
 SENSOR_LOCATION_UUID = "2A5D"
 SENSOR_LOCATION_CHAR_UUID = 0x2A5D
 SENSOR_LOCATION_OTHER = 0
@@ -58,9 +78,6 @@ DI_MANUFACTURER_NAME_UUID = "2A29"
 BAT_UUID = "180F"
 BAT_LEVEL_UUID = "2A19"
 
-CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT = 0b0000_0001
-CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT = 0b0000_0010
-
 # feature flags
 CP_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT = 0b0001_0000
 CP_F_BIT_CRANK_REVOLUTION_DATA_PRESENT = 0b0010_0000
@@ -68,6 +85,21 @@ CP_F_BIT_CRANK_REVOLUTION_DATA_PRESENT = 0b0010_0000
 CP_M_BIT_WHEEL_REVOLUTION_DATA_PRESENT = 0b0000_0100
 CP_M_BIT_CRANK_REVOLUTION_DATA_PRESENT = 0b0000_1000
 
+# fitness machine features
+FTMS_F_BIT_CADENCE_SUPPORTED = 1 << 1
+FTMS_F_BIT_TOTAL_DISTANCE_SUPPORTED = 1 << 2
+FTMS_F_BIT_RESISTANCE_LEVEL_SUPPORTED = 1 << 7
+FTMS_F_BIT_EXPENDED_ENERGY_SUPPORTED = 1 << 9
+FTMS_F_BIT_HEART_RATE_MEASUREMENT_SUPPORTED = 1 << 10
+FTMS_F_BIT_POWER_MEASUREMENT_SUPPORTED = 1 << 14
+# service data of the advertisement: machine available, indoor bike
+FTMS_SERVICE_DATA = bytes([0x01, 0x20, 0x00])
+
+# BLETx output modes
+BLE_MODE_CP_CSC = "cp-csc"
+BLE_MODE_FTMS = "ftms"
+BLE_MODES = (BLE_MODE_CP_CSC, BLE_MODE_FTMS)
+
 
 class BatteryService(Service):
     def __init__(self):
@@ -123,6 +155,7 @@ class CPService(Service):
             # | CP_F_BIT_CRANK_REVOLUTION_DATA_PRESENT
             # | CP_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT
         )
+        self.measurement = CPMeasurement()
         super().__init__(CP_UUID, primary=True)
 
     @characteristic(CP_MEASUREMENT_UUID, CharFlags.NOTIFY | CharFlags.READ)
@@ -130,17 +163,9 @@ class CPService(Service):
         pass
 
     def notify_new_rate(self, power, w_event_ms, c_event_ms, crank_rev, wheel_rev):
-        rate = struct.pack(
-            "<Hh",
-            *[
-                self.measure_flags,
-                power & 0x7FFF,
-                # wheel_rev & 0xFFFFFFFF,
-                # w_event_ms & 0xFFFF,
-                # crank_rev & 0xFFFF,
-                # c_event_ms & 0xFFFF,
-            ],
-        )
+        # wheel and crank revolution data are not sent, see measure_flags
+        rate = self.measurement.encode(self.measure_flags, power)
+        # the codecs return bytes, which dbus_next requires for "ay"
         self.cp_measurement.changed(rate)
 
     @characteristic(CP_FEATURE_UUID, CharFlags.READ)
@@ -164,6 +189,9 @@ class CSCService(Service):
             | CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT
             | CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT
         )
+        self.measurement_all = CSCMeasurement()
+        self.measurement_crank = CSCCrankMeasurement()
+        self.measurement_wheel = CSCWheelMeasurement()
 
     @characteristic(CSC_MEASUREMENT_UUID, CharFlags.NOTIFY | CharFlags.READ)
     def csc_measurement(self, options):
@@ -174,33 +202,15 @@ class CSCService(Service):
     #     return struct.pack("<H", *[0x0001])
 
     def notify_all(self, wheel_rev, crank_rev, w_event_ms, c_event_ms):
-        rate = struct.pack(
-            "<BIHHH",
-            CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT
-            | CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT,
-            wheel_rev & 0xFFFFFFFF,
-            w_event_ms & 0xFFFF,
-            crank_rev & 0xFFFF,
-            c_event_ms & 0xFFFF,
-        )
+        rate = self.measurement_all.encode(wheel_rev, crank_rev, w_event_ms, c_event_ms)
         self.csc_measurement.changed(rate)
 
     def notify_crank(self, wheel_rev, crank_rev, w_event_ms, c_event_ms):
-        rate = struct.pack(
-            "<BHH",
-            CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT,
-            crank_rev & 0xFFFF,
-            c_event_ms & 0xFFFF,
-        )
+        rate = self.measurement_crank.encode(crank_rev, c_event_ms)
         self.csc_measurement.changed(rate)
 
     def notify_wheel(self, wheel_rev, crank_rev, w_event_ms, c_event_ms):
-        rate = struct.pack(
-            "<BIH",
-            CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT,
-            wheel_rev & 0xFFFFFFFF,
-            w_event_ms & 0xFFFF,
-        )
+        rate = self.measurement_wheel.encode(wheel_rev, w_event_ms)
         self.csc_measurement.changed(rate)
 
     @characteristic(CSC_FEATURE_UUID, CharFlags.READ)
@@ -216,78 +226,185 @@ class CSCService(Service):
         pass
 
 
-class BLETx:
-    def __init__(self) -> None:
+class FTMSService(Service):
+    """Fitness machine, one indoor bike data notification carries the whole reading"""
+
+    def __init__(self):
+        super().__init__(FTMS_UUID, True)
+        self.feature = (
+            0
+            | FTMS_F_BIT_CADENCE_SUPPORTED
+            | FTMS_F_BIT_TOTAL_DISTANCE_SUPPORTED
+            | FTMS_F_BIT_RESISTANCE_LEVEL_SUPPORTED
+            | FTMS_F_BIT_EXPENDED_ENERGY_SUPPORTED
+            | FTMS_F_BIT_HEART_RATE_MEASUREMENT_SUPPORTED
+            | FTMS_F_BIT_POWER_MEASUREMENT_SUPPORTED
+        )
+        self.indoor_bike_data_codec = FTMSIndoorBikeData()
+
+    @characteristic(FTMS_FEATURE_UUID, CharFlags.READ)
+    def ftms_feature(self, options):
+        # fitness machine features, no target settings
+        return struct.pack("<II", self.feature, 0)
+
+    @characteristic(FTMS_INDOOR_BIKE_DATA_UUID, CharFlags.NOTIFY)
+    def indoor_bike_data(self, options):
         pass
 
+    def encode(self, bike_data):
+        return self.indoor_bike_data_codec.encode(
+            speed=bike_data.get_speed(),
+            cadence=bike_data.get_cadence(),
+            distance=bike_data.get_distance(),
+            resistance=bike_data.get_resistance(),
+            power=bike_data.get_power(),
+            calories=bike_data.get_calories(),
+            hr=bike_data.get_heart_rate(),
+        )
+
+    def notify(self, payload):
+        self.indoor_bike_data.changed(payload)
+
+
+class BLETx:
+    def __init__(
+        self, metrics=None, period=0.25, keepalive=1.0, mode=BLE_MODE_CP_CSC
+    ) -> None:
+        """Notifications are only sent when a value changed, or after `keepalive` seconds of silence
+
+        `mode` selects the services: separate CP and CSC measurements, or FTMS indoor bike data with everything in one notification.
+        """
+        if mode not in BLE_MODES:
+            raise ValueError(f"unknown BLE mode {mode}")
+        # optional monitor.metrics.Metrics
+        self.metrics = metrics
+        self.period = period
+        self.keepalive = keepalive
+        self.mode = mode
+        self.bat_service = BatteryService()
+        self.di_service = DeviceInformationService()
+        if mode == BLE_MODE_FTMS:
+            self.ftms_service = FTMSService()
+            self.services = [self.bat_service, self.di_service, self.ftms_service]
+            self.service_uuids = [BAT_UUID, DI_UUID, FTMS_UUID]
+            self.service_data = {FTMS_UUID: FTMS_SERVICE_DATA}
+        else:
+            self.cp_service = CPService()
+            self.csc_service = CSCService()
+            self.services = [
+                self.bat_service,
+                self.di_service,
+                self.cp_service,
+                self.csc_service,
+            ]
+            self.service_uuids = [BAT_UUID, DI_UUID, CP_UUID, CSC_UUID]
+            self.service_data = {}
+
+        self.bus = None
+        # unique bus name of bluetoothd the services are registered with
+        self.bluez_owner = None
+        # set while the services are registered, nothing is notified otherwise
+        self.ready = False
+        # when the output went down, until its first notification
+        self.down_since = clock()
+
+    async def get_bluez_owner(self):
+        reply = await self.bus.call(
+            Message(
+                destination="org.freedesktop.DBus",
+                path="/org/freedesktop/DBus",
+                interface="org.freedesktop.DBus",
+                member="GetNameOwner",
+                signature="s",
+                body=["org.bluez"],
+            )
+        )
+        if reply.message_type == MessageType.ERROR:
+            return None
+        return reply.body[0]
+
     async def setup(self):
-        bus = await get_message_bus()
+        bus = self.bus = await get_message_bus()
+        self.bluez_owner = await self.get_bluez_owner()
 
-        bat_service = BatteryService()
-        di_service = DeviceInformationService()
-        cp_service = CPService()
-        csc_service = CSCService()
-        svcs = ServiceCollection([bat_service, di_service, cp_service, csc_service])
+        svcs = ServiceCollection(list(self.services))
         await svcs.register(bus)
 
-        self.bat_service = bat_service
-        self.di_service = di_service
-        self.cp_service = cp_service
-        self.csc_service = csc_service
-
         # An agent is required to handle pairing
         # This script may need superuser for this to work.
         agent = NoIoAgent()
         await agent.register(bus)
 
         adapter = await Adapter.get_first(bus)
-        print(await adapter.get_address())
+        log.info("advertising on adapter %s", await adapter.get_address())
 
         # Start an advert that will last for 60 seconds.
         advert = Advertisement(
             localName="Keiser M to GATT",
-            serviceUUIDs=[BAT_UUID, DI_UUID, CP_UUID, CSC_UUID],
+            serviceUUIDs=self.service_uuids,
+            serviceData=self.service_data,
             appearance=0x0480,
             timeout=0,
             includes=AdvertisingIncludes.TX_POWER,
         )
         await advert.register(bus, adapter)
-
-    async def loop(self, bike_data):
+        self.ready = True
+
+    async def teardown(self):
+        self.ready = False
+        if self.bus is not None:
+            # drops every exported object, setup exports them again
+            self.bus.disconnect()
+            try:
+                await self.bus.wait_for_disconnect()
+            except Exception as e:
+                # lost rather than closed, that is what is being handled
+                log.warning("bus lost: %s", e)
+            self.bus = None
+
+    async def run(self, poll=2, retry=2):
+        """Registers the services, and again whenever bluetoothd restarts or the bus is lost"""
         while True:
-            await asyncio.sleep(0.25)
-            if bike_data.no_data:
-                print("BLE: No data")
-                continue
-
-            wr = bike_data.get_wr()
-            cr = bike_data.get_cr()
-            wev = bike_data.get_wev()
-            cev = bike_data.get_cev()
-            power = bike_data.get_power()
-            print(
-                "BLE TX: ",
-                f"{power:3d} W {wr:6d} wREV {cr:6d} cREV",
-                f"w{wev:5d} ms c{cev:5d} ms {bike_data.speed * 3.6 / 1.67:2.1f} mph",
-                time.time(),
-                end="\n",
-            )
-            # if crank_rev_cls.notify and wheel_rev_cls.notify:
-            if 1:
-                self.csc_service.notify_all(
-                    wheel_rev=wr, crank_rev=cr, w_event_ms=wev, c_event_ms=cev
-                )
-                # crank_rev_cls.notify = False
-                # wheel_rev_cls.notify = False
-                # else:
-                #     if crank_rev_cls.notify:
-                #         csc_service.notify_crank(
-                #             wheel_rev=wr, crank_rev=cr, w_event_ms=wev, c_event_ms=cev
-                #         )
-                #     if wheel_rev_cls.notify:
-                #         csc_service.notify_wheel(
-                #             wheel_rev=wr, crank_rev=cr, w_event_ms=wev, c_event_ms=cev
-                #         )
+            try:
+                await self.setup()
+                while self.bus.connected:
+                    await asyncio.sleep(poll)
+                    if await self.get_bluez_owner() != self.bluez_owner:
+                        log.warning("bluetoothd restarted")
+                        break
+            except Exception as e:
+                log.error("setup failed: %s", e)
+            if self.ready:
+                self.down_since = clock()
+            await self.teardown()
+            await asyncio.sleep(retry)
+
+    def notify_cp_csc(self, bike_data, now):
+        """CSC and CP measurements, returns whether anything was notified"""
+        wr = bike_data.get_wr()
+        cr = bike_data.get_cr()
+        wev = bike_data.get_wev()
+        cev = bike_data.get_cev()
+        power = bike_data.get_power()
+        sent = False
+        # a new revolution event comes with a new count
+        wheel = wr != self.last_wr
+        crank = cr != self.last_cr
+        if now - self.csc_time >= self.keepalive:
+            wheel = crank = True
+        if wheel or crank:
+            if wheel and crank:
+                notify = self.csc_service.notify_all
+            elif crank:
+                notify = self.csc_service.notify_crank
+            else:
+                notify = self.csc_service.notify_wheel
+            notify(wheel_rev=wr, crank_rev=cr, w_event_ms=wev, c_event_ms=cev)
+            self.last_wr, self.last_cr = wr, cr
+            self.csc_time = now
+            sent = True
+
+        if power != self.last_power or now - self.cp_time >= self.keepalive:
             self.cp_service.notify_new_rate(
                 power=power,
                 wheel_rev=wr,
@@ -295,4 +412,59 @@ class BLETx:
                 w_event_ms=wev,
                 c_event_ms=cev,
             )
+            self.last_power = power
+            self.cp_time = now
+            sent = True
+        return sent
+
+    def notify_ftms(self, bike_data, now):
+        """FTMS indoor bike data, returns whether it was notified"""
+        payload = self.ftms_service.encode(bike_data)
+        if payload == self.last_payload and now - self.ftms_time < self.keepalive:
+            return False
+        self.ftms_service.notify(payload)
+        self.last_payload = payload
+        self.ftms_time = now
+        return True
+
+    async def loop(self, bike_data):
+        schedule = PeriodicSchedule(self.period)
+        sent_seq = 0
+        if self.mode == BLE_MODE_FTMS:
+            notify = self.notify_ftms
+        else:
+            notify = self.notify_cp_csc
+        # what was notified last and when
+        self.last_wr = self.last_cr = self.last_power = self.last_payload = None
+        self.csc_time = self.cp_time = self.ftms_time = float("-inf")
+        while True:
+            missed = await schedule.wait()
+            if missed:
+                log.warning("missed %d deadlines", missed)
+                if self.metrics is not None:
+                    self.metrics.observe_missed("ble", bike_data.bike_id, missed)
+            if bike_data.idle:
+                # no wakeups and no keepalive notifications until the next reading
+                await bike_data.wait_active()
+                schedule.reset()
+                continue
+            if bike_data.no_data:
+                continue
+            if not self.ready:
+                continue
+
+            now = clock()
+            if not notify(bike_data, now):
+                continue
+
+            if self.down_since is not None:
+                seconds = now - self.down_since
+                self.down_since = None
+                log.info("first notification after %.2f s", seconds)
+                if self.metrics is not None:
+                    self.metrics.observe_first_tx("ble", bike_data.bike_id, seconds)
+
+            if self.metrics is not None and bike_data.seq != sent_seq:
+                sent_seq = bike_data.seq
+                self.metrics.observe_tx("ble", bike_data, now)
         # Handle dbus requests.
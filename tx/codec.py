@@ -0,0 +1,244 @@
+import struct
+
+ANT_SPEED_PAGE_ID = 0x00
+ANT_POWER_PAGE_ID = 0x10
+ANT_FE_GENERAL_PAGE_ID = 0x10
+ANT_FE_SETTINGS_PAGE_ID = 0x11
+ANT_FE_TRAINER_PAGE_ID = 0x19
+# common pages every ANT+ profile interleaves
+ANT_MANUFACTURER_INFO_PAGE_ID = 0x50
+ANT_PRODUCT_INFO_PAGE_ID = 0x51
+ANT_MANUFACTURER_DEVELOPMENT = 255
+
+# ANT+ FE equipment type, trainer/stationary bike
+ANT_FE_TYPE_TRAINER = 25
+# FE state in the upper nibble of the last byte of every FE page
+ANT_FE_STATE_IN_USE = 3 << 4
+# general FE data capabilities
+ANT_FE_CAP_HR_SOURCE_EM = 0b10
+ANT_FE_CAP_DISTANCE_ENABLED = 1 << 2
+ANT_FE_CAP_VIRTUAL_SPEED = 1 << 3
+
+CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT = 0b0000_0001
+CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT = 0b0000_0010
+
+# FTMS indoor bike data flags, instantaneous speed is present while bit 0 is clear
+FTMS_IBD_BIT_INSTANTANEOUS_CADENCE_PRESENT = 1 << 2
+FTMS_IBD_BIT_TOTAL_DISTANCE_PRESENT = 1 << 4
+FTMS_IBD_BIT_RESISTANCE_LEVEL_PRESENT = 1 << 5
+FTMS_IBD_BIT_INSTANTANEOUS_POWER_PRESENT = 1 << 6
+FTMS_IBD_BIT_EXPENDED_ENERGY_PRESENT = 1 << 8
+FTMS_IBD_BIT_HEART_RATE_PRESENT = 1 << 9
+
+
+class Codec:
+    """Precompiled struct packing
+
+    The format is parsed once, `encode` returns a new bytes object. That is the one allocation per payload; radios and D-Bus take it as is, without another copy.
+    """
+
+    FORMAT = ""
+
+    def __init__(self) -> None:
+        self.struct = struct.Struct(self.FORMAT)
+        self.pack = self.struct.pack
+
+    def encode(self, *fields):
+        return self.pack(*fields)
+
+
+class ANTPowerPage(Codec):
+    """ANT+ bicycle power, standard power-only page 0x10"""
+
+    FORMAT = "<BB" + "BB" + "HH"
+
+    def encode(self, event_count, cadence, cum_power, power):
+        # 0xFF: pedal power not used
+        return self.pack(
+            ANT_POWER_PAGE_ID, event_count, 0xFF, cadence, cum_power, power
+        )
+
+
+class ANTSpeedPage(Codec):
+    """ANT+ bicycle speed, default page 0x00"""
+
+    FORMAT = "<B" + "BH" + "HH"
+
+    def encode(self, event_time_ms, cum_rev_count):
+        return self.pack(ANT_SPEED_PAGE_ID, 0xFF, 0xFFFF, event_time_ms, cum_rev_count)
+
+
+class ANTFEGeneralPage(Codec):
+    """ANT+ FE general FE data, page 0x10"""
+
+    FORMAT = "<BBBBHBB"
+
+    def encode(self, elapsed_time, distance, speed, heart_rate):
+        """elapsed time in 0.25 s and distance in m, both rolling over at 256, speed in mm/s, heart rate 0 if unknown"""
+        capabilities = ANT_FE_CAP_DISTANCE_ENABLED | ANT_FE_CAP_VIRTUAL_SPEED
+        if heart_rate:
+            capabilities |= ANT_FE_CAP_HR_SOURCE_EM
+        else:
+            heart_rate = 0xFF
+        return self.pack(
+            ANT_FE_GENERAL_PAGE_ID,
+            ANT_FE_TYPE_TRAINER,
+            elapsed_time & 0xFF,
+            distance & 0xFF,
+            speed & 0xFFFF,
+            heart_rate,
+            capabilities | ANT_FE_STATE_IN_USE,
+        )
+
+
+class ANTFESettingsPage(Codec):
+    """ANT+ FE general settings, page 0x11, only the resistance is known"""
+
+    FORMAT = "<BBBBhBB"
+
+    def encode(self, resistance):
+        """resistance in 0.5 %"""
+        # 0xFF and 0x7FFF: cycle length and incline are invalid
+        return self.pack(
+            ANT_FE_SETTINGS_PAGE_ID,
+            0xFF,
+            0xFF,
+            0xFF,
+            0x7FFF,
+            min(resistance, 200),
+            ANT_FE_STATE_IN_USE,
+        )
+
+
+class ANTManufacturerInfoPage(Codec):
+    """ANT+ common page 0x50, manufacturer's information"""
+
+    FORMAT = "<BBBBHH"
+
+    def encode(self, hw_revision, manufacturer, model):
+        return self.pack(
+            ANT_MANUFACTURER_INFO_PAGE_ID,
+            0xFF,
+            0xFF,
+            hw_revision,
+            manufacturer,
+            model,
+        )
+
+
+class ANTProductInfoPage(Codec):
+    """ANT+ common page 0x51, product information"""
+
+    FORMAT = "<BBBBI"
+
+    def encode(self, sw_revision, serial):
+        # 0xFF: no supplemental software revision
+        return self.pack(ANT_PRODUCT_INFO_PAGE_ID, 0xFF, 0xFF, sw_revision, serial)
+
+
+class ANTFETrainerPage(Codec):
+    """ANT+ FE specific trainer/stationary bike data, page 0x19"""
+
+    FORMAT = "<BBBHHB"
+
+    def encode(self, event_count, cadence, cum_power, power):
+        # power is 12 bits, the trainer status bits above it are all clear,
+        # no target power so the flags are clear too
+        return self.pack(
+            ANT_FE_TRAINER_PAGE_ID,
+            event_count,
+            cadence,
+            cum_power,
+            power & 0x0FFF,
+            ANT_FE_STATE_IN_USE,
+        )
+
+
+class CSCMeasurement(Codec):
+    """BLE CSC measurement carrying wheel and crank revolution data"""
+
+    FORMAT = "<BIHHH"
+    FLAGS = (
+        CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT
+        | CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT
+    )
+
+    def encode(self, wheel_rev, crank_rev, w_event_ms, c_event_ms):
+        return self.pack(
+            self.FLAGS,
+            wheel_rev & 0xFFFFFFFF,
+            w_event_ms & 0xFFFF,
+            crank_rev & 0xFFFF,
+            c_event_ms & 0xFFFF,
+        )
+
+
+class CSCCrankMeasurement(Codec):
+    """BLE CSC measurement carrying crank revolution data only"""
+
+    FORMAT = "<BHH"
+
+    def encode(self, crank_rev, c_event_ms):
+        return self.pack(
+            CSC_F_BIT_CRANK_REVOLUTION_DATA_PRESENT,
+            crank_rev & 0xFFFF,
+            c_event_ms & 0xFFFF,
+        )
+
+
+class CSCWheelMeasurement(Codec):
+    """BLE CSC measurement carrying wheel revolution data only"""
+
+    FORMAT = "<BIH"
+
+    def encode(self, wheel_rev, w_event_ms):
+        return self.pack(
+            CSC_F_BIT_WHEEL_REVOLUTION_DATA_PRESENT,
+            wheel_rev & 0xFFFFFFFF,
+            w_event_ms & 0xFFFF,
+        )
+
+
+class CPMeasurement(Codec):
+    """BLE CP measurement with instantaneous power only"""
+
+    FORMAT = "<Hh"
+
+    def encode(self, flags, power):
+        return self.pack(flags, power & 0x7FFF)
+
+
+class FTMSIndoorBikeData(Codec):
+    """BLE FTMS indoor bike data with everything a Keiser bike reports
+
+    19 bytes, so it fits a notification at the default ATT MTU of 23. Elapsed time is left out for that reason.
+    """
+
+    # flags, speed, cadence, distance (uint24 as 16 + 8 bits), resistance, power,
+    # total energy, energy per hour, energy per minute, heart rate
+    FORMAT = "<HHH" + "HB" + "hh" + "HHB" + "B"
+    FLAGS = (
+        FTMS_IBD_BIT_INSTANTANEOUS_CADENCE_PRESENT
+        | FTMS_IBD_BIT_TOTAL_DISTANCE_PRESENT
+        | FTMS_IBD_BIT_RESISTANCE_LEVEL_PRESENT
+        | FTMS_IBD_BIT_INSTANTANEOUS_POWER_PRESENT
+        | FTMS_IBD_BIT_EXPENDED_ENERGY_PRESENT
+        | FTMS_IBD_BIT_HEART_RATE_PRESENT
+    )
+
+    def encode(self, speed, cadence, distance, resistance, power, calories, hr):
+        """speed in 0.01 km/h, cadence in 0.5 rpm, distance in m, calories in kcal"""
+        return self.pack(
+            self.FLAGS,
+            speed & 0xFFFF,
+            cadence & 0xFFFF,
+            distance & 0xFFFF,
+            (distance >> 16) & 0xFF,
+            resistance,
+            power,
+            calories & 0xFFFF,
+            # energy per hour and minute: not available
+            0xFFFF,
+            0xFF,
+            hr & 0xFF,
+        )
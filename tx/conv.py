@@ -1,7 +1,10 @@
-import time
 from . import *
-from bike import Bike
-import asyncio
+from .rolling import get_rolling_power
+from .speed import SpeedModel, get_speed_model
+from bike import Bike, Broadcast, clock
+
+# set wheel to 700c*25 or ~2096mm
+WHEEL_CIRCUMFERENCE = 2.096
 
 
 def uint8(val):
@@ -17,17 +20,27 @@ def uint32(val):
 
 
 class Conv:
-    def __init__(self, data_src: Bike) -> None:
+    def __init__(
+        self, data_src: Bike, speed_model: SpeedModel = None, metrics=None
+    ) -> None:
         self.data_src = data_src
-        self.last_feed_time = time.time()
+        self.bike_id = getattr(data_src, "bike_id", 0)
+        self.speed_model = get_speed_model() if speed_model is None else speed_model
+        self.last_feed_time = clock()
 
         self.flag_crank_encoder = True if hasattr(data_src, "rev_inc") else False
         self.flag_power_to_speed = True if hasattr(data_src, "power") else False
+        self.flag_distance = True if hasattr(data_src, "distance") else False
 
         # common concepts
         self.power = 0
         self.cadence = 0  # crank rpm
         self.speed = 0  # wheel m/s
+        self.distance = 0  # km
+        # passed through from sources that report them
+        self.heart_rate = 0  # bpm
+        self.calories = 0  # kcal
+        self.resistance = 0  # percent
 
         # BLE concepts
         self.cr = 0
@@ -39,23 +52,41 @@ class Conv:
         self.power_event_counts = 0
         self.cum_power = 0
 
+        # 3/10/30 s averages, NP and interval max of the bike, tx.rolling.RollingPower
+        self.rolling = get_rolling_power(data_src)
+
         self.no_data = True
+        # the bike went idle, outputs power down until its next reading
+        self.idle = False
+        # sequence number of the last consumed data_src reading
+        self.seq = 0
+        # published once this Conv has taken in a reading or a drop out
+        self.new_data = Broadcast()
+
+        # stage timestamps of that reading, clock()
+        self.rx_time = 0
+        self.conv_time = 0
+        # optional monitor.metrics.Metrics
+        self.metrics = metrics
+        # called with this Conv after every reading, e.g. tx.shm.TelemetryWriter
+        self.listeners = []
 
     async def loop(self):
         wheel_count = CountGenerator()
         crank_count = CountGenerator()
 
         while True:
-            # await self.data_src.new_data.wait()
-            await asyncio.sleep(0.05)
+            self.seq = await self.data_src.new_data.wait(self.seq)
 
+            self.idle = getattr(self.data_src, "idle", False)
             if self.data_src.no_data:
                 self.no_data = True
+                self.new_data.publish()
                 continue
             else:
                 self.no_data = False
 
-            now = time.time()
+            now = clock()
             dt = now - self.last_feed_time
             self.last_feed_time = now
 
@@ -69,23 +100,53 @@ class Conv:
                 crank_count.add(self.cadence * dt / 60, now)
 
             if self.flag_power_to_speed:
-                speed = power_to_speed(self.power)
-                # set wheel to 700c*25 or ~2096mm
-                WHEEL_CIRCUMFERENCE = 2.096
+                speed = self.speed_model.speed(self.power)
                 inc = (speed + self.speed) / 2 * dt / WHEEL_CIRCUMFERENCE
                 self.speed = speed
             else:
                 inc = self.data_src.rev_inc
             self.power = self.data_src.power
+            self.rolling.update(self.seq, self.data_src.last_changed, self.power)
             wheel_count.add(inc, now)
 
             self.cr, self.cev = crank_count.get()
             self.wr, self.wev = wheel_count.get()
 
+            if self.flag_distance:
+                self.distance = self.data_src.distance
+            else:
+                self.distance = wheel_count.val_float * WHEEL_CIRCUMFERENCE / 1000
+            self.heart_rate = getattr(self.data_src, "heart_rate", 0)
+            self.calories = getattr(self.data_src, "calories", 0)
+            self.resistance = getattr(self.data_src, "resistence", 0)
+
             # power events
             self.power_event_counts += 1
             self.cum_power += self.power
 
+            self.rx_time = self.data_src.last_changed
+            self.conv_time = clock()
+            if self.metrics is not None:
+                self.metrics.observe(
+                    "rx_to_conv", self.bike_id, self.conv_time - self.rx_time
+                )
+            for listener in self.listeners:
+                listener(self)
+            self.new_data.publish()
+
+    async def wait_active(self):
+        """Returns once the bike is no longer idle"""
+        seq = self.new_data.seq
+        while self.idle:
+            seq = await self.new_data.wait(seq)
+
+    def get_average_power(self, window):
+        """W, over one of tx.rolling.POWER_WINDOWS seconds"""
+        return uint16(self.rolling.averages[window])
+
+    def get_normalized_power(self):
+        return uint16(self.rolling.normalized_power)
+
 
 class BLEConv(Conv):
     def get_wr(self):
@@ -103,6 +164,27 @@ class BLEConv(Conv):
     def get_power(self):
         return uint16(self.power)
 
+    def get_speed(self):
+        """0.01 km/h"""
+        return uint16(self.speed * 360)
+
+    def get_cadence(self):
+        """0.5 rpm"""
+        return uint16(self.cadence * 2)
+
+    def get_distance(self):
+        """m"""
+        return int(self.distance * 1000) & 0xFFFFFF
+
+    def get_resistance(self):
+        return int(self.resistance)
+
+    def get_heart_rate(self):
+        return uint8(self.heart_rate)
+
+    def get_calories(self):
+        return uint16(self.calories)
+
 
 class ANTConv(Conv):
     def get_event_count(self):
@@ -122,3 +204,18 @@ class ANTConv(Conv):
 
     def get_event_time_ms(self):
         return uint16(self.wev)
+
+    def get_speed(self):
+        """mm/s"""
+        return uint16(self.speed * 1000)
+
+    def get_distance(self):
+        """m, rolls over at 256"""
+        return uint8(self.distance * 1000)
+
+    def get_heart_rate(self):
+        return uint8(self.heart_rate)
+
+    def get_resistance(self):
+        """0.5 %"""
+        return uint8(self.resistance * 2)
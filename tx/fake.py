@@ -0,0 +1,74 @@
+"""Stand-ins for the radios, so pipelines can run without ANT sticks or BlueZ"""
+
+from bike import clock
+
+
+class FakeChannel:
+    def __init__(self, node, number) -> None:
+        self.node = node
+        self.number = number
+        self.network = None
+        self.period = 0
+        self.frequency = 0
+        self.is_open = False
+
+    def assign(self, network, channel_type):
+        self.network = network
+
+    def setID(self, device_type, device_number, trans_type):
+        self.device_type = device_type
+        self.device_number = device_number
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def unassign(self):
+        self.network = None
+
+
+class FakeNode:
+    """Mimics ant.core.node.Node, broadcast messages are counted and optionally handed to `on_send`"""
+
+    def __init__(self, channels=8, on_send=None) -> None:
+        self.channels = [FakeChannel(self, i) for i in range(channels)]
+        self.on_send = on_send
+        self.running = False
+        self.sent = 0
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def setNetworkKey(self, number, key):
+        pass
+
+    def getFreeChannel(self):
+        for channel in self.channels:
+            if channel.network is None:
+                return channel
+        raise RuntimeError("Could not find free channel.")
+
+    def send(self, msg):
+        self.sent += 1
+        if self.on_send is not None:
+            self.on_send(clock(), msg)
+
+
+class FakeCharacteristic:
+    """Stands in for a notifying bluez_peripheral characteristic"""
+
+    def __init__(self, on_changed=None) -> None:
+        self.on_changed = on_changed
+        self.changes = 0
+
+    def changed(self, new_value):
+        # as strict as dbus_next, which rejects a bytearray for an "ay" value
+        assert isinstance(new_value, bytes), type(new_value)
+        self.changes += 1
+        if self.on_changed is not None:
+            self.on_changed(clock(), new_value)
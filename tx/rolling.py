@@ -0,0 +1,100 @@
+"""Rolling power averages, normalized power and interval maxima, updated in O(1) per reading"""
+
+import array
+import weakref
+
+# seconds of the rolling averages, normalized power is based on the longest
+POWER_WINDOWS = (3, 10, 30)
+
+
+class RollingPower:
+    """Time windowed averages over a fixed size ring buffer of (time, power) samples
+
+    Every window keeps a running sum and the oldest sample it still covers; a new sample is added to all sums and the samples that left a window are taken out, each once, so a reading costs the same whatever the window length. `capacity` bounds the samples held, it covers the longest window up to capacity / window readings a second.
+
+    Normalized power is the 4th root of the mean of the 4th power of the longest average, taken at every reading.
+    """
+
+    def __init__(self, windows=POWER_WINDOWS, capacity=512) -> None:
+        self.windows = windows
+        self.capacity = capacity
+        self.times = array.array("d", [0.0]) * capacity
+        self.powers = array.array("d", [0.0]) * capacity
+        # samples ever added, the next one goes to head % capacity
+        self.head = 0
+        # per window, the first sample it covers and the sum from there to head
+        self.tails = [0] * len(windows)
+        self.sums = [0.0] * len(windows)
+        # average power by window length
+        self.averages = dict.fromkeys(windows, 0.0)
+
+        self.np4_sum = 0.0
+        self.np_count = 0
+        self.normalized_power = 0.0
+
+        self.new_interval()
+        # source sequence number of the latest sample
+        self.seq = 0
+
+    def new_interval(self):
+        """Starts over the interval maximum and average, e.g. at a lap"""
+        self.interval_max = 0
+        self.interval_sum = 0.0
+        self.interval_count = 0
+
+    @property
+    def interval_avg(self):
+        return self.interval_sum / self.interval_count if self.interval_count else 0.0
+
+    def update(self, seq, t, power):
+        """Adds the reading `seq` of the source, a reading already added is skipped"""
+        if seq <= self.seq:
+            return False
+        self.seq = seq
+
+        times, powers, capacity = self.times, self.powers, self.capacity
+        i = self.head % capacity
+        # ring full, the oldest sample leaves every window before it is overwritten
+        oldest = self.head - capacity
+        if oldest >= 0:
+            for k, tail in enumerate(self.tails):
+                if tail == oldest:
+                    self.sums[k] -= powers[i]
+                    self.tails[k] = tail + 1
+        times[i] = t
+        powers[i] = power
+        self.head += 1
+
+        for k, window in enumerate(self.windows):
+            total = self.sums[k] + power
+            tail = self.tails[k]
+            start = t - window
+            # stops at the sample just added at the latest
+            while times[tail % capacity] <= start:
+                total -= powers[tail % capacity]
+                tail += 1
+            self.tails[k] = tail
+            self.sums[k] = total
+            self.averages[window] = total / (self.head - tail)
+
+        self.np4_sum += self.averages[self.windows[-1]] ** 4
+        self.np_count += 1
+        self.normalized_power = (self.np4_sum / self.np_count) ** 0.25
+
+        if power > self.interval_max:
+            self.interval_max = power
+        self.interval_sum += power
+        self.interval_count += 1
+        return True
+
+
+# by data source, so all Convs of a bike share one
+_rolling = weakref.WeakKeyDictionary()
+
+
+def get_rolling_power(data_src):
+    """Shared `RollingPower` of a data source, the first Conv to see a reading adds it"""
+    rolling = _rolling.get(data_src)
+    if rolling is None:
+        rolling = _rolling[data_src] = RollingPower()
+    return rolling
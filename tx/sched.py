@@ -0,0 +1,45 @@
+import asyncio
+
+# ANT channel periods are configured in units of 1/32768 s
+ANT_PERIOD_UNIT = 1 / 32768
+
+
+class PeriodicSchedule:
+    """Fires at the absolute deadlines start + k * period of the event loop clock
+
+    The work done between two ticks does not shift the following ones, so there is no drift. If the loop falls behind by whole periods those ticks are skipped, not fired in a burst, and `wait` reports how many were missed.
+    """
+
+    def __init__(self, period) -> None:
+        self.period = period
+        self.deadline = None
+        self.ticks = 0
+        self.missed = 0
+
+    def reset(self):
+        """The next `wait` fires right away and the deadlines count from then, e.g. after the output was paused"""
+        self.deadline = asyncio.get_running_loop().time() - self.period
+
+    async def wait(self):
+        """Sleeps until the next deadline, returns the number of deadlines missed since the last call"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.period
+
+        missed = 0
+        if now - self.deadline >= self.period:
+            missed = int((now - self.deadline) // self.period)
+            self.deadline += missed * self.period
+            self.missed += missed
+
+        if self.deadline > now:
+            fired = loop.create_future()
+            handle = loop.call_at(self.deadline, fired.set_result, None)
+            try:
+                await fired
+            finally:
+                handle.cancel()
+        self.ticks += 1
+        return missed
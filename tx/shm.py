@@ -0,0 +1,169 @@
+"""Live telemetry of every Conv tick in a shared memory ring buffer
+
+The bridge writes, any number of processes on the same machine read by attaching to the segment by name, no sockets or syscalls per sample:
+
+    from tx.shm import TelemetryReader
+    reader = TelemetryReader("keiser")
+    for record in reader.follow():
+        print(record.bike_id, record.power)
+
+Layout, little endian: a header (magic, capacity, record size, sequence number of the last record written) followed by `capacity` fixed size records. Record n goes to slot (n - 1) % capacity. Every slot starts with the sequence number of the record in it, zero while it is being written, so a reader can tell a torn or overwritten record from a good one without any lock.
+"""
+
+import collections
+import logging
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+log = logging.getLogger(__name__)
+
+TELEMETRY_MAGIC = b"KSRTEL01"
+TELEMETRY_HEADER = struct.Struct("<8sIIQ")
+# the slot sequence number comes first, then the fields in this order
+TELEMETRY_FIELDS = (
+    ("seq", "Q"),
+    ("bike_id", "I"),
+    ("src_seq", "I"),
+    ("time", "d"),  # time.time() of the tick, for recorders
+    ("rx_time", "d"),  # clock() stage timestamps, see monitor.metrics
+    ("conv_time", "d"),
+    ("power", "d"),
+    ("cadence", "d"),
+    ("speed", "d"),
+    ("cr", "I"),
+    ("cev", "I"),
+    ("wr", "I"),
+    ("wev", "I"),
+    ("power_event_counts", "Q"),
+    ("cum_power", "Q"),
+)
+TELEMETRY_RECORD = struct.Struct("<" + "".join(code for _, code in TELEMETRY_FIELDS))
+TELEMETRY_SEQ = struct.Struct("<Q")
+# where the last sequence number is in the header
+HEADER_SEQ_OFFSET = TELEMETRY_HEADER.size - TELEMETRY_SEQ.size
+
+TelemetryRecord = collections.namedtuple(
+    "TelemetryRecord", [name for name, _ in TELEMETRY_FIELDS]
+)
+
+
+class TelemetryWriter:
+    """Owns the segment, publishes ticks of the Convs it is a listener of"""
+
+    def __init__(self, name="keiser", capacity=4096) -> None:
+        self.capacity = capacity
+        size = TELEMETRY_HEADER.size + capacity * TELEMETRY_RECORD.size
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a run that was killed before close()
+            log.warning("removing stale telemetry segment %s", name)
+            stale = shared_memory.SharedMemory(name)
+            stale.unlink()
+            stale.close()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.buf = self.shm.buf
+        self.seq = 0
+        TELEMETRY_HEADER.pack_into(
+            self.buf, 0, TELEMETRY_MAGIC, capacity, TELEMETRY_RECORD.size, 0
+        )
+
+    def __call__(self, conv):
+        self.publish(conv)
+
+    def publish(self, conv):
+        self.seq += 1
+        offset = (
+            TELEMETRY_HEADER.size
+            + (self.seq - 1) % self.capacity * TELEMETRY_RECORD.size
+        )
+        # invalidate the slot, fill it, then stamp it and advance the header
+        TELEMETRY_SEQ.pack_into(self.buf, offset, 0)
+        TELEMETRY_RECORD.pack_into(
+            self.buf,
+            offset,
+            0,
+            conv.bike_id,
+            conv.seq & 0xFFFFFFFF,
+            time.time(),
+            conv.rx_time,
+            conv.conv_time,
+            conv.power,
+            conv.cadence,
+            conv.speed,
+            int(conv.cr) & 0xFFFFFFFF,
+            int(conv.cev) & 0xFFFFFFFF,
+            int(conv.wr) & 0xFFFFFFFF,
+            int(conv.wev) & 0xFFFFFFFF,
+            conv.power_event_counts,
+            conv.cum_power,
+        )
+        TELEMETRY_SEQ.pack_into(self.buf, offset, self.seq)
+        TELEMETRY_SEQ.pack_into(self.buf, HEADER_SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class TelemetryReader:
+    """Attaches to a TelemetryWriter segment, starting at its latest record"""
+
+    def __init__(self, name="keiser") -> None:
+        self.shm = shared_memory.SharedMemory(name)
+        # the writer owns the segment, do not let this process remove it on exit
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+        magic, self.capacity, record_size, self.seq = TELEMETRY_HEADER.unpack_from(
+            self.buf, 0
+        )
+        if magic != TELEMETRY_MAGIC or record_size != TELEMETRY_RECORD.size:
+            self.shm.close()
+            raise ValueError(f"{name} is not a telemetry ring of this version")
+        # records overwritten before they could be read
+        self.lost = 0
+
+    def head(self):
+        return TELEMETRY_SEQ.unpack_from(self.buf, HEADER_SEQ_OFFSET)[0]
+
+    def get(self, seq):
+        """Record `seq`, or None if it was overwritten meanwhile"""
+        offset = (
+            TELEMETRY_HEADER.size + (seq - 1) % self.capacity * TELEMETRY_RECORD.size
+        )
+        record = TELEMETRY_RECORD.unpack_from(self.buf, offset)
+        if record[0] != seq or TELEMETRY_SEQ.unpack_from(self.buf, offset)[0] != seq:
+            return None
+        return TelemetryRecord._make(record)
+
+    def latest(self):
+        seq = self.head()
+        return None if seq == 0 else self.get(seq)
+
+    def read(self):
+        """Every record written since the last call"""
+        head = self.head()
+        if head - self.seq > self.capacity:
+            self.lost += head - self.seq - self.capacity
+            self.seq = head - self.capacity
+        records = []
+        for seq in range(self.seq + 1, head + 1):
+            record = self.get(seq)
+            if record is None:
+                self.lost += 1
+            else:
+                records.append(record)
+        self.seq = head
+        return records
+
+    def follow(self, interval=0.05):
+        """Yields new records as they come, polling every `interval` seconds"""
+        while True:
+            yield from self.read()
+            time.sleep(interval)
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
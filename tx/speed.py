@@ -0,0 +1,74 @@
+from functools import lru_cache
+
+from . import power_to_speed
+
+
+class SpeedModel:
+    """Power to speed lookup table for one rider and bike parameter set
+
+    The cubic in `power_to_speed` is solved once per table entry when the model is built, after that a conversion is a table lookup plus a linear interpolation. Powers beyond the table fall back to the exact solution.
+    """
+
+    def __init__(
+        self,
+        mass=75,
+        Cd=0.9,
+        A=0.5,
+        rho=1.225,
+        Crr=0.0045,
+        max_power=2500,
+        step=1.0,
+    ) -> None:
+        self.params = (mass, Cd, A, rho, Crr)
+        self.step = step
+        n = int(max_power / step) + 1
+        self.max_power = (n - 1) * step
+        self.table = [power_to_speed(i * step, *self.params) for i in range(n)]
+
+        # built on first use of the batch api
+        self.np_power = None
+        self.np_speed = None
+
+    def speed(self, power):
+        """power in watts, speed in m/s"""
+        if power <= 0:
+            return 0.0
+        x = power / self.step
+        i = int(x)
+        if i >= len(self.table) - 1:
+            return power_to_speed(power, *self.params)
+        lo = self.table[i]
+        return lo + (self.table[i + 1] - lo) * (x - i)
+
+    def speeds(self, powers):
+        """Convert a whole array of powers in watts to speeds in m/s"""
+        import numpy as np
+
+        if self.np_speed is None:
+            self.np_speed = np.asarray(self.table)
+            self.np_power = np.arange(len(self.table)) * self.step
+
+        powers = np.asarray(powers, dtype=np.float64)
+        out = np.interp(powers, self.np_power, self.np_speed, left=0.0)
+        over = powers > self.max_power
+        if over.any():
+            out[over] = self.solve(powers[over])
+        return out
+
+    def solve(self, powers):
+        """Exact vectorized solution of the cubic, see `power_to_speed`"""
+        import numpy as np
+
+        mass, Cd, A, rho, Crr = self.params
+        coeff_P_drag = 0.5 * Cd * A * rho
+        coeff_P_roll = Crr * mass * 9.81
+        p = coeff_P_roll / coeff_P_drag
+        q = -np.asarray(powers, dtype=np.float64) / coeff_P_drag
+        delta = np.sqrt(p**3 / 27 + q**2 / 4)
+        return np.cbrt(-q / 2 + delta) + np.cbrt(-q / 2 - delta)
+
+
+@lru_cache(maxsize=None)
+def get_speed_model(mass=75, Cd=0.9, A=0.5, rho=1.225, Crr=0.0045):
+    """Shared `SpeedModel` per parameter set, so many bikes with the same rider model build the table once"""
+    return SpeedModel(mass, Cd, A, rho, Crr)